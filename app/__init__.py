@@ -13,8 +13,9 @@ from flask import Flask
 from flask_cors import CORS
 from flask_jwt_extended import JWTManager
 
-from app.sockets import socketio
+from app.sockets import socketio, start_scheduler
 from app.routes import bp
+from app import redis_storage, db, question_pool
 
 
 def create_app():
@@ -41,6 +42,29 @@ def create_app():
 
     app.register_blueprint(bp)
 
+    # Переводим комнаты, сохранённые в старом формате (pickle), в поля Redis
+    migrated = redis_storage.migrate_pickled_rooms()
+    if migrated:
+        app.logger.info(f'Migrated {migrated} pickled rooms')
+
+    # Добавляем в индекс лобби комнаты, созданные до его появления
+    categories = db.get_categories()['categories'] or []
+    indexed = redis_storage.rebuild_lobby_index({cat['id']: cat['name'] for cat in categories})
+    if indexed:
+        app.logger.info(f'Indexed {indexed} waiting rooms in lobby')
+
+    # Индексы и таблица статистики игроков в MySQL: без них не записать ни одной игры,
+    # поэтому воркер с неготовой схемой не запускается
+    if not db.migrate_schema():
+        raise RuntimeError('Migration of MySQL schema failed')
+
+    # Прогреваем кэш вопросов, чтобы создание комнат не ходило в MySQL
+    cached = db.warm_question_cache()
+    app.logger.info(f'Cached {cached} questions')
+
+    # Темы для пула GPT-вопросов: все категории и «любая тематика»
+    question_pool.register_topics([cat['name'] for cat in categories if cat['id'] != os.getenv('GPT_CATEGORY_ID')])
+
     redis_url = f"redis://{os.getenv('REDIS_HOST', 'localhost')}:{os.getenv('REDIS_PORT', '6379')}/0"
 
     socketio.init_app(
@@ -51,5 +75,6 @@ def create_app():
         async_mode="eventlet",
         message_queue=redis_url
     )
+    start_scheduler()
 
     return app
@@ -1,22 +1,82 @@
+import hashlib
 import json
 import mysql.connector
+from mysql.connector import pooling
 import bcrypt
 import os
+import sys
+import time
+from threading import BoundedSemaphore, Lock
 from typing import List
 from app.models import Room, Question, Player
 import random
-from app.gpt import get_gpt_questions
+from bisect import bisect_right
+from collections import Counter, OrderedDict
+from dataclasses import replace
+from itertools import accumulate
+from app import question_pool, gpt, redis_storage
+
+
+# bcrypt — ~250 мс чистого CPU. Под eventlet такой вызов в обработчике замораживает
+# все сокеты воркера, поэтому хеширование идёт в настоящих потоках (eventlet.tpool):
+# одновременно не больше BCRYPT_WORKERS вызовов, в очереди — не больше BCRYPT_MAX_QUEUE,
+# сверх этого вход и регистрация отвечают «сервер занят».
+BCRYPT_ROUNDS = int(os.getenv('BCRYPT_ROUNDS', '12'))
+BCRYPT_WORKERS = int(os.getenv('BCRYPT_WORKERS', str(os.cpu_count() or 1)))
+BCRYPT_MAX_QUEUE = int(os.getenv('BCRYPT_MAX_QUEUE', '64'))
+_bcrypt_slots = BoundedSemaphore(BCRYPT_WORKERS)
+bcrypt_stats = {
+    "calls": 0,
+    "queued": 0,
+    "max_queued": 0,
+    "rejected": 0,
+    "max_wait_ms": 0.0,
+}
+
+
+def _in_green_thread():
+    patcher = sys.modules.get('eventlet.patcher')
+    return patcher is not None and patcher.is_monkey_patched('thread')
+
+
+def bcrypt_busy():
+    return bcrypt_stats["queued"] >= BCRYPT_MAX_QUEUE
+
+
+def _run_bcrypt(fn, *args):
+    started = time.monotonic()
+    bcrypt_stats["queued"] += 1
+    bcrypt_stats["max_queued"] = max(bcrypt_stats["max_queued"], bcrypt_stats["queued"])
+    try:
+        with _bcrypt_slots:
+            wait_ms = (time.monotonic() - started) * 1000
+            bcrypt_stats["max_wait_ms"] = max(bcrypt_stats["max_wait_ms"], wait_ms)
+            bcrypt_stats["calls"] += 1
+            if _in_green_thread():
+                from eventlet import tpool
+                return tpool.execute(fn, *args)
+            return fn(*args)
+    finally:
+        bcrypt_stats["queued"] -= 1
+
+
+def get_bcrypt_stats():
+    stats = dict(bcrypt_stats)
+    stats["workers"] = BCRYPT_WORKERS
+    stats["max_queue"] = BCRYPT_MAX_QUEUE
+    return stats
 
 
 def create_hash(password):
-    salt = bcrypt.gensalt(rounds=12)
-    password_hash = bcrypt.hashpw(password.encode('utf-8'), salt)
+    salt = bcrypt.gensalt(rounds=BCRYPT_ROUNDS)
+    password_hash = _run_bcrypt(bcrypt.hashpw, password.encode('utf-8'), salt)
     hash_str = password_hash.decode('utf-8')
     return hash_str
 
 
 def is_password_true(password, password_hash):
-    return bcrypt.checkpw(
+    return _run_bcrypt(
+        bcrypt.checkpw,
         password.encode('utf-8'),
         password_hash.encode('utf-8')
     )
@@ -24,32 +84,72 @@ def is_password_true(password, password_hash):
 
 def sign_up(username, password):
     if username == '' or password == '': return {'success': False}
-    password_hash = create_hash(password)
+    if bcrypt_busy():
+        bcrypt_stats["rejected"] += 1
+        return {'success': False, 'busy': True}
     if get_from_bd('SELECT id FROM users WHERE username = (%s)', (username,), one_row=True):
         return {'success': False}
+    password_hash = create_hash(password)
+    if put_to_bd('INSERT INTO users (username, password_hash) VALUES (%s,%s)', (username, password_hash)):
+        return {'success': True}
     else:
-        if put_to_bd('INSERT INTO users (username, password_hash) VALUES (%s,%s)', (username, password_hash)):
-            return {'success': True}
-        else:
-            return {'success': False}
+        return {'success': False}
 
 
 def sign_in(username, password):
     if username == '' or password == '': return {'success': False}
-    data = get_from_bd('SELECT id, password_hash FROM users WHERE username = (%s)', [username], one_row=True)
+    if bcrypt_busy():
+        bcrypt_stats["rejected"] += 1
+        return {'success': False, 'user_id': None, 'busy': True}
+    data = get_from_bd('SELECT id, username, password_hash FROM users WHERE username = (%s)', [username],
+                       one_row=True)
     if not data:
         return {'success': False, 'user_id': None}
     password_hash = data['password_hash']
     user_id = data['id']
     if is_password_true(password, password_hash):
-        return {'success': True, 'user_id': user_id}
+        # Сравнение в MySQL без учёта регистра: в токен и кэш идёт имя из базы, а не как его ввели
+        username = data['username']
+        redis_storage.cache_username(user_id, username)
+        _cache_user(user_id, username)
+        return {'success': True, 'user_id': user_id, 'login': username}
     else:
         return {'success': False, 'user_id': None}
 
 
+# Имена пользователей не меняются, поэтому кэшируются: локальный LRU перед общим кэшем в Redis
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', '10000'))
+USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL', '600'))
+_user_cache = OrderedDict()
+_user_cache_lock = Lock()
+user_cache_stats = {"local_hits": 0, "redis_hits": 0, "misses": 0}
+
+
+def _cache_user(user_id, username):
+    with _user_cache_lock:
+        _user_cache[user_id] = (time.monotonic(), username)
+        _user_cache.move_to_end(user_id)
+        while len(_user_cache) > USER_CACHE_SIZE:
+            _user_cache.popitem(last=False)
+
+
 def get_user(user_id):
+    with _user_cache_lock:
+        entry = _user_cache.get(user_id)
+        if entry is not None and time.monotonic() - entry[0] <= USER_CACHE_TTL:
+            _user_cache.move_to_end(user_id)
+            user_cache_stats["local_hits"] += 1
+            return {"success": True, "login": entry[1]}
+    username = redis_storage.get_cached_username(user_id)
+    if username is not None:
+        user_cache_stats["redis_hits"] += 1
+        _cache_user(user_id, username)
+        return {"success": True, "login": username}
+    user_cache_stats["misses"] += 1
     data = get_from_bd('SELECT username FROM users WHERE id = (%s)', (user_id,), one_row=True)
     if data:
+        redis_storage.cache_username(user_id, data['username'])
+        _cache_user(user_id, data['username'])
         return {"success": True, "login": data['username']}
     else:
         return {"success": False, "login": None}
@@ -60,87 +160,358 @@ def create_question(category_id, text, options, correct_answer, time_limit=30):
     if put_to_bd(
             "INSERT INTO questions (category_id, text, options, correct_answer, time_limit) VALUES (%s,%s,%s,%s,%s)",
             (category_id, text, options, correct_answer, time_limit)):
+        invalidate_questions(category_id)
         return {"success": True}
     return {"success": False}
 
 
+# Статистика игрока копится при сохранении каждой игры — профиль не пересчитывает историю
+USER_STATS_UPSERT = """
+INSERT INTO user_stats (user_id, games_played, wins, total_score, correct_answers, questions_total, best_score)
+VALUES {values}
+AS new
+ON DUPLICATE KEY UPDATE
+    games_played = games_played + new.games_played,
+    wins = wins + new.wins,
+    total_score = total_score + new.total_score,
+    correct_answers = correct_answers + new.correct_answers,
+    questions_total = questions_total + new.questions_total,
+    best_score = GREATEST(best_score, new.best_score)
+"""
+
+
 def save_room(room: Room):
-    room_id = room.room_id
-    owner_user_id = room.owner.user_id
-    start = room.timer_start
-    amount = len(room.questions)
-    put_room = put_to_bd("INSERT INTO rooms (id, owner, creation, amount) VALUES (%s,%s,%s,%s)",
-                         (room_id, owner_user_id, start, amount))
-    sql = 'INSERT INTO rooms_users (room_id, user_id, score, correct, place) VALUES'
-    params = []
-    players: List[Player] = list(room.players.values())
-    players.sort(key=lambda x: x.score, reverse=True)
-    place = 1
-    for player in players:
-        params.extend((room_id, player.user_id, player.score, player.correct, place))
-        sql += ' (%s,%s,%s,%s,%s), '
-        place += 1
-    sql = sql[:-2]
-    sql += ';'
-    put_players = put_to_bd(sql, params)
-    if put_room and put_players:
+    return save_rooms([room])
+
+
+def save_rooms(rooms: List[Room]):
+    """Сохраняет завершённые игры одной транзакцией. Уже сохранённые (по room_id) пропускаются,
+    поэтому повторная запись той же игры безопасна."""
+    placeholders = ', '.join(['%s'] * len(rooms))
+    existing = get_from_bd(f"SELECT id FROM rooms WHERE id in ({placeholders})",
+                           tuple(room.room_id for room in rooms)) if rooms else None
+    existing = {row['id'] for row in existing or []}
+    rooms = list({room.room_id: room for room in rooms if room.room_id not in existing}.values())
+    if not rooms:
         return {'success': True}
-    else:
+    rooms_params = []
+    users_params = []
+    # Итоги по игрокам для user_stats: games_played, wins, total_score, correct, questions, best_score
+    stats = {}
+    for room in rooms:
+        # Без времени начала игра не попала бы в постраничную историю — берём время записи
+        creation = room.timer_start or time.strftime("%Y-%m-%d %H:%M:%S")
+        rooms_params.extend((room.room_id, room.owner.user_id if room.owner else None, creation,
+                             len(room.questions)))
+        players: List[Player] = list(room.players.values())
+        players.sort(key=lambda x: x.score, reverse=True)
+        for place, player in enumerate(players, start=1):
+            users_params.extend((room.room_id, player.user_id, player.score, player.correct, place, creation))
+            games, wins, score, correct, questions, best = stats.get(player.user_id, (0, 0, 0, 0, 0, 0))
+            stats[player.user_id] = (games + 1, wins + (place == 1), score + player.score,
+                                     correct + player.correct, questions + len(room.questions),
+                                     max(best, player.score))
+    statements = [("INSERT INTO rooms (id, owner, creation, amount) VALUES " +
+                   ', '.join(['(%s,%s,%s,%s)'] * len(rooms)), rooms_params)]
+    if users_params:
+        statements.append(("INSERT INTO rooms_users (room_id, user_id, score, correct, place, creation) VALUES " +
+                           ', '.join(['(%s,%s,%s,%s,%s,%s)'] * (len(users_params) // 6)), users_params))
+        statements.append((USER_STATS_UPSERT.format(values=', '.join(['(%s,%s,%s,%s,%s,%s,%s)'] * len(stats))),
+                           [value for user_id, row in stats.items() for value in (user_id, *row)]))
+    if not put_many_to_bd(statements):
         return {'success': False}
+    for room in rooms:
+        # Запоминаем вопросы из базы как виденные, чтобы не повторять их игрокам
+        redis_storage.mark_questions_seen(list(room.players),
+                                          [q.id for q in room.questions if q.category_id != os.getenv('GPT_CATEGORY_ID')])
+    return {'success': True}
 
 
-def get_categories():
+# Категории: локальная копия сверяется с версией в Redis не чаще раза в CATEGORY_CHECK_INTERVAL секунд;
+# при смене версии список берётся из Redis, а если его там нет — из MySQL
+CATEGORY_CHECK_INTERVAL = float(os.getenv('CATEGORY_CHECK_INTERVAL', '5'))
+_categories = {"version": None, "checked_at": None, "categories": None, "etag": None}
+_categories_lock = Lock()
+
+
+def _load_categories():
     data = get_from_bd("SELECT * FROM categories")
-    if data:
-        categories = []
-        for category in data:
-            categories.append({"id": category["id"], "name": category["name"]})
-        return {"success": True, "categories": categories}
+    if not data:
+        return None
+    categories = []
+    for category in data:
+        categories.append({"id": category["id"], "name": category["name"]})
+    return categories
+
+
+def _refresh_categories():
+    # Сетевые запросы — вне _categories_lock: блокировка защищает только локальную копию
+    version, categories = redis_storage.get_cached_categories()
+    with _categories_lock:
+        if version == _categories["version"] and _categories["categories"] is not None:
+            return
+    if categories is None:
+        categories = _load_categories()
+        if categories is None:
+            return
+        redis_storage.cache_categories(categories, version)
+    etag = hashlib.sha1(json.dumps(categories, sort_keys=True).encode('utf-8')).hexdigest()
+    with _categories_lock:
+        # Параллельная сверка могла уже положить более новую версию
+        if _categories["version"] is None or version >= _categories["version"]:
+            _categories.update(version=version, categories=categories, etag=etag)
+
+
+def get_categories():
+    with _categories_lock:
+        checked_at = _categories["checked_at"]
+        refresh = checked_at is None or time.monotonic() - checked_at > CATEGORY_CHECK_INTERVAL
+        if refresh:
+            # Сверку делает один поток, остальные тем временем отдают текущую копию
+            _categories["checked_at"] = time.monotonic()
+        loaded = _categories["categories"] is not None
+    if refresh or not loaded:
+        _refresh_categories()
+    with _categories_lock:
+        categories = _categories["categories"]
+        etag = _categories["etag"]
+    if categories:
+        return {"success": True, "categories": list(categories), "etag": etag}
     else:
-        return {"success": False, "categories": None}
+        return {"success": False, "categories": None, "etag": None}
+
 
+def invalidate_categories():
+    """Вызывать после изменения таблицы categories: все воркеры перечитают список."""
+    redis_storage.bump_categories_version()
+    with _categories_lock:
+        _categories["checked_at"] = None
 
-def get_questions(count_questions, category_ids):
+
+def get_questions(count_questions, category_ids, user_ids=None):
     if not count_questions or count_questions < 1: count_questions = 10
     count_questions = min(count_questions, 50)
     if os.getenv('GPT_CATEGORY_ID') in category_ids:
         category_ids.remove(os.getenv('GPT_CATEGORY_ID'))
-        categories = get_categories()
-        for k in categories['categories']:
-            if k['id'] in category_ids:
-                category_ids.remove(k['id'])
-                category_ids.append(k['name'])
-        return get_gpt_questions(count_questions, category_ids)
-    sql = "SELECT * FROM questions "
-    if category_ids:
-        placeholders = ', '.join(['%s'] * len(category_ids))
-        sql += f'WHERE category_id in ({placeholders}) '
-    sql += 'ORDER BY RAND() LIMIT %s;'
-    data = get_from_bd(sql, (*category_ids, count_questions))
-    if data:
-        questions = []
-        for question in data:
-            options = json.loads(question['options'])["list"]
-            random.shuffle(options)
-            questions.append(
-                Question(id=question['id'],
-                         text=question['text'],
-                         options=options,
-                         correct_answer=question['correct_answer'],
-                         time_limit=question['time_limit'],
-                         category_id=question['category_id']))
-        return {'success': True, 'questions': questions}
-    else:
-        return {'success': True, 'questions': None}
+        categories = get_categories()['categories'] or []
+        topics = [k['name'] for k in categories if k['id'] in category_ids]
+        # Вопросы берутся из заранее сгенерированного пула, без ожидания LLM
+        result = question_pool.take_questions(count_questions, topics, generate_missing=False)
+        result['fallback_category_ids'] = category_ids
+        if result.get('pending') and gpt.circuit_open(take_trial=False):
+            # LLM недоступен — недостающие вопросы берём из базы
+            fallback = sample_questions(result['pending'], category_ids, user_ids)
+            result['questions'] = (result['questions'] or []) + (fallback['questions'] or [])
+            result['success'] = bool(result['questions'])
+            result['pending'] = 0
+        return result
+    return sample_questions(count_questions, category_ids, user_ids)
+
+
+# Индекс id вопросов по категориям лежит в Redis (SRANDMEMBER), а не в памяти каждого
+# воркера: случайная выборка без ORDER BY RAND(). При смене версии вопросов в Redis
+# (или раз в QUESTION_INDEX_TTL секунд) фоновая задача одного из воркеров сверяет с базой
+# подписи категорий — число вопросов и сумму CRC32 их id — и перечитывает только
+# изменившиеся категории; запросы индекс только читают. Сумма ловит и удаление
+# с последующей вставкой, при которых число вопросов не меняется.
+QUESTION_INDEX_TTL = float(os.getenv('QUESTION_INDEX_TTL', '300'))
+QUESTION_SIGNATURES_SQL = "SELECT category_id, COUNT(*) AS cnt, SUM(CRC32(id)) AS checksum FROM questions"
+_question_index_lock = Lock()
+
+# Разобранные вопросы по id (LRU): при тёплом кэше создание комнаты не ходит в MySQL
+QUESTION_CACHE_SIZE = int(os.getenv('QUESTION_CACHE_SIZE', '20000'))
+_question_cache = OrderedDict()
+_question_cache_lock = Lock()
+question_cache_stats = {"hits": 0, "misses": 0}
+
+
+def _question_signature(row):
+    return f"{row['cnt']}:{int(row['checksum'] or 0)}"
+
+
+def _load_category_ids(category_id, signature):
+    rows = get_from_bd("SELECT id FROM questions WHERE category_id = %s", (category_id,))
+    if rows is None:
+        # База недоступна — оставляем старый набор, подпись не обновляем
+        return
+    removed = redis_storage.replace_question_ids(category_id, [row['id'] for row in rows], signature)
+    _evict_questions(removed)
+
+
+def refresh_question_index(category_id=None):
+    with _question_index_lock:
+        # Пока ждали блокировку, индекс мог сверить другой поток
+        if category_id is None and not question_index_stale():
+            return
+        # Версию читаем до сверки: изменения, сделанные во время сверки, подхватим в следующий раз
+        version = redis_storage.get_questions_version() if category_id is None else None
+        if category_id is None:
+            rows = get_from_bd(QUESTION_SIGNATURES_SQL + " GROUP BY category_id")
+        else:
+            rows = get_from_bd(QUESTION_SIGNATURES_SQL + " WHERE category_id = %s GROUP BY category_id",
+                               (category_id,))
+        if rows is None:
+            # База недоступна (или пуста) — работаем со старым индексом, проверим при следующем запросе
+            return
+        signatures = {row['category_id']: _question_signature(row) for row in rows}
+        stored = redis_storage.get_question_index_signatures()
+        if category_id is None:
+            gone = [cat_id for cat_id in stored if cat_id not in signatures]
+            if gone:
+                _evict_questions(redis_storage.remove_question_categories(gone))
+        for cat_id, signature in signatures.items():
+            if stored.get(cat_id) != signature:
+                _load_category_ids(cat_id, signature)
+        if category_id is None:
+            redis_storage.set_question_index_checked(version, time.time())
+
+
+def invalidate_questions(category_id=None):
+    """Сообщает всем воркерам, что вопросы изменились; индекс категории в Redis обновляется сразу."""
+    if category_id is not None:
+        refresh_question_index(category_id)
+    redis_storage.bump_questions_version()
+
+
+def question_index_stale():
+    version, checked_at = redis_storage.get_question_index_checked()
+    if checked_at is None or time.time() - checked_at > QUESTION_INDEX_TTL:
+        return True
+    return redis_storage.get_questions_version() != version
+
+
+def warm_question_cache():
+    """Загружает индекс (если его ещё не сверил другой воркер) и до QUESTION_CACHE_SIZE вопросов в кэш."""
+    refresh_question_index()
+    data = get_from_bd("SELECT * FROM questions LIMIT %s", (QUESTION_CACHE_SIZE,))
+    _cache_questions(_parse_question_row(row) for row in data or [])
+    return len(_question_cache)
+
+
+def _cache_questions(questions):
+    with _question_cache_lock:
+        for question in questions:
+            _question_cache[question.id] = question
+            _question_cache.move_to_end(question.id)
+        while len(_question_cache) > QUESTION_CACHE_SIZE:
+            _question_cache.popitem(last=False)
+
+
+def _evict_questions(question_ids):
+    with _question_cache_lock:
+        for question_id in question_ids:
+            _question_cache.pop(question_id, None)
+
+
+def _sample_index(count_questions, category_ids):
+    # Повтор категории в запросе не должен удваивать её вес
+    category_ids = list(dict.fromkeys(category_ids or redis_storage.get_question_index_signatures()))
+    bounds = list(accumulate(redis_storage.get_question_index_sizes(category_ids)))
+    total = bounds[-1] if bounds else 0
+    # Равномерная выборка без повторов из объединения категорий: сначала решаем,
+    # сколько вопросов взять из каждой, затем берём их из Redis
+    counts = Counter(category_ids[bisect_right(bounds, pick)]
+                     for pick in random.sample(range(total), min(count_questions, total)))
+    ids = redis_storage.random_question_ids(counts)
+    random.shuffle(ids)
+    return ids
+
 
+def get_questions_by_ids(question_ids):
+    """Вопросы по id: сначала из кэша, недостающие — одним запросом по первичному ключу."""
+    found = {}
+    missing = []
+    with _question_cache_lock:
+        for question_id in question_ids:
+            question = _question_cache.get(question_id)
+            if question is None:
+                missing.append(question_id)
+            else:
+                _question_cache.move_to_end(question_id)
+                found[question_id] = question
+    question_cache_stats["hits"] += len(found)
+    question_cache_stats["misses"] += len(missing)
+    if missing:
+        placeholders = ', '.join(['%s'] * len(missing))
+        data = get_from_bd(f"SELECT * FROM questions WHERE id in ({placeholders})", tuple(missing))
+        loaded = [_parse_question_row(row) for row in data or []]
+        _cache_questions(loaded)
+        found.update((question.id, question) for question in loaded)
+    # Каждой комнате — своя копия с перемешанными вариантами
+    return [replace(found[question_id], options=random.sample(found[question_id].options,
+                                                              len(found[question_id].options)))
+            for question_id in question_ids if question_id in found]
 
-def get_past_games(user_id):
+
+# Во сколько раз больше кандидатов выбирать, чтобы после отсева виденных хватило вопросов
+SEEN_OVERSAMPLE = int(os.getenv('SEEN_OVERSAMPLE', '3'))
+
+
+def sample_question_ids(count_questions, category_ids, user_ids=None, exclude_ids=()):
+    """user_ids — игроки, чьи недавно виденные вопросы выбираются в последнюю очередь."""
+    oversample = SEEN_OVERSAMPLE if user_ids else 1
+    ids = [question_id for question_id in _sample_index(count_questions * oversample + len(exclude_ids), category_ids)
+           if question_id not in exclude_ids]
+    if user_ids:
+        seen = redis_storage.get_seen_questions(user_ids, ids)
+        # Если невиденных не хватает, добираем виденными
+        ids = [question_id for question_id in ids if question_id not in seen] + \
+              [question_id for question_id in ids if question_id in seen]
+    return ids[:count_questions]
+
+
+def sample_questions(count_questions, category_ids, user_ids=None):
+    """Случайные вопросы без ORDER BY RAND(): id берутся из индекса, вопросы — из кэша или по первичному ключу."""
+    ids = sample_question_ids(count_questions, category_ids, user_ids)
+    questions = get_questions_by_ids(ids) if ids else None
+    return {'success': True, 'questions': questions or None}
+
+
+def replace_seen_questions(questions, user_ids):
+    """Заменяет вопросы из базы, которые уже видел кто-то из игроков, невиденными из тех же категорий.
+
+    Возвращает список той же длины и в том же порядке."""
+    candidates = [question.id for question in questions if question.category_id != os.getenv('GPT_CATEGORY_ID')]
+    seen = redis_storage.get_seen_questions(user_ids, candidates)
+    if not seen:
+        return questions
+    room_ids = {question.id for question in questions}
+    replacements = {}
+    for category_id in {question.category_id for question in questions if question.id in seen}:
+        count = sum(1 for question in questions if question.id in seen and question.category_id == category_id)
+        ids = sample_question_ids(count, [category_id], user_ids, exclude_ids=room_ids)
+        fresh = [question for question in get_questions_by_ids(ids) if question.id not in seen]
+        replacements[category_id] = fresh
+    result = []
+    for question in questions:
+        if question.id in seen and replacements.get(question.category_id):
+            question = replacements[question.category_id].pop()
+        result.append(question)
+    return result
+
+
+def _parse_question_row(question):
+    return Question(id=question['id'],
+                    text=question['text'],
+                    options=json.loads(question['options'])["list"],
+                    correct_answer=question['correct_answer'],
+                    time_limit=question['time_limit'],
+                    category_id=question['category_id'])
+
+
+PAST_GAMES_PAGE_SIZE = 20
+
+
+def get_past_games(user_id, limit=PAST_GAMES_PAGE_SIZE, before=None):
+    """Страница истории игр, новые сверху. before — (creation, room_id) последней игры
+    предыдущей страницы; по индексу (user_id, creation, room_id) читается только страница."""
     sql = """
     SELECT
         ru.room_id,
         ru.score,
         ru.correct,
         ru.place,
+        ru.creation AS played_at,
         r.amount,
         r.creation,
         r.end,
@@ -151,11 +522,18 @@ def get_past_games(user_id):
     JOIN users u ON r.owner = u.id
     WHERE ru.user_id = %s
     """
-    data = get_from_bd(sql, (user_id,))
+    params = [user_id]
+    if before:
+        sql += " AND (ru.creation < %s OR (ru.creation = %s AND ru.room_id < %s))"
+        params.extend((before[0], before[0], before[1]))
+    sql += " ORDER BY ru.creation DESC, ru.room_id DESC LIMIT %s"
+    params.append(limit)
+    data = get_from_bd(sql, tuple(params))
     if data:
         games = []
         for row in data:
             game = {
+                "room_id": row["room_id"],
                 "score": row["score"],
                 "correct": row["correct"],
                 "owner_id": row["owner_id"],
@@ -166,25 +544,157 @@ def get_past_games(user_id):
                 "place": row["place"]
             }
             games.append(game)
-        return {"success": True, "games": games}
-    return {"success": True, "games": []}
+        last = data[-1]
+        next_before = (str(last["played_at"]), last["room_id"]) if len(data) == limit else None
+        return {"success": True, "games": games, "next_before": next_before}
+    return {"success": True, "games": [], "next_before": None}
+
+
+def get_user_stats(user_id):
+    data = get_from_bd("SELECT * FROM user_stats WHERE user_id = %s", (user_id,), one_row=True)
+    if not data:
+        return {"success": True, "stats": {"games_played": 0, "wins": 0, "total_score": 0, "avg_score": 0,
+                                           "best_score": 0, "accuracy": 0}}
+    games = data["games_played"]
+    return {"success": True, "stats": {
+        "games_played": games,
+        "wins": data["wins"],
+        "total_score": data["total_score"],
+        "avg_score": round(data["total_score"] / games, 1) if games else 0,
+        "best_score": data["best_score"],
+        "accuracy": round(data["correct_answers"] / data["questions_total"], 3) if data["questions_total"] else 0,
+    }}
+
+
+# Изменения схемы MySQL, которые приложение применяет само при старте.
+# Каждый шаг проверяет, не выполнен ли он уже; GET_LOCK не даёт двум воркерам мигрировать одновременно.
+USER_STATS_TABLE = """
+CREATE TABLE user_stats (
+    user_id VARCHAR(36) NOT NULL PRIMARY KEY,
+    games_played INT NOT NULL DEFAULT 0,
+    wins INT NOT NULL DEFAULT 0,
+    total_score BIGINT NOT NULL DEFAULT 0,
+    correct_answers INT NOT NULL DEFAULT 0,
+    questions_total INT NOT NULL DEFAULT 0,
+    best_score INT NOT NULL DEFAULT 0
+)
+SELECT
+    ru.user_id,
+    COUNT(*) AS games_played,
+    SUM(ru.place = 1) AS wins,
+    SUM(ru.score) AS total_score,
+    SUM(ru.correct) AS correct_answers,
+    SUM(r.amount) AS questions_total,
+    MAX(ru.score) AS best_score
+FROM rooms_users ru
+JOIN rooms r ON ru.room_id = r.id
+GROUP BY ru.user_id
+"""
+
+
+def _schema_count(cursor, sql, params):
+    cursor.execute(sql, params)
+    return cursor.fetchone()['cnt']
+
+
+# Пока один воркер мигрирует (заполнение user_stats на большой базе — долго), остальные ждут
+SCHEMA_LOCK_TIMEOUT = int(os.getenv('SCHEMA_LOCK_TIMEOUT', '300'))
+
+
+def migrate_schema():
+    """True, если схема готова. Без неё запись завершённых игр невозможна,
+    поэтому при False приложение не запускается."""
+    mydb = None
+    try:
+        mydb = bd_connect()
+        cursor = mydb.cursor(dictionary=True)
+        cursor.execute("SELECT GET_LOCK('quiz_schema', %s) AS locked", (SCHEMA_LOCK_TIMEOUT,))
+        if not cursor.fetchone()['locked']:
+            print("Не удалось получить блокировку для миграции схемы")
+            return False
+        try:
+            # Время игры рядом с user_id — история читается по индексу без сортировки всех игр
+            if not _schema_count(cursor, "SELECT COUNT(*) AS cnt FROM information_schema.columns WHERE "
+                                         "table_schema = DATABASE() AND table_name = %s AND column_name = %s",
+                                 ('rooms_users', 'creation')):
+                cursor.execute("ALTER TABLE rooms_users ADD COLUMN creation DATETIME NULL")
+            # Строки без времени недостижимы для выборки по (creation, room_id) — заполняем
+            # их и запрещаем NULL; игры без времени начала получают время окончания или 1970 год
+            if _schema_count(cursor, "SELECT COUNT(*) AS cnt FROM information_schema.columns WHERE "
+                                     "table_schema = DATABASE() AND table_name = %s AND column_name = %s "
+                                     "AND is_nullable = 'YES'", ('rooms_users', 'creation')):
+                cursor.execute("UPDATE rooms_users ru LEFT JOIN rooms r ON ru.room_id = r.id "
+                               "SET ru.creation = COALESCE(r.creation, r.end, '1970-01-01 00:00:00') "
+                               "WHERE ru.creation IS NULL")
+                cursor.execute("ALTER TABLE rooms_users MODIFY creation DATETIME NOT NULL")
+                mydb.commit()
+            if not _schema_count(cursor, "SELECT COUNT(*) AS cnt FROM information_schema.statistics WHERE "
+                                         "table_schema = DATABASE() AND table_name = %s AND index_name = %s",
+                                 ('rooms_users', 'rooms_users_user_creation')):
+                cursor.execute("CREATE INDEX rooms_users_user_creation ON rooms_users (user_id, creation, room_id)")
+            # Таблица статистики создаётся сразу заполненной по уже сыгранным играм
+            if not _schema_count(cursor, "SELECT COUNT(*) AS cnt FROM information_schema.tables WHERE "
+                                         "table_schema = DATABASE() AND table_name = %s", ('user_stats',)):
+                cursor.execute(USER_STATS_TABLE)
+                mydb.commit()
+        finally:
+            cursor.execute("SELECT RELEASE_LOCK('quiz_schema')")
+            cursor.fetchall()
+            cursor.close()
+        return True
+    except Exception as e:
+        print(f'Ошибка миграции схемы: {e}')
+        return False
+    finally:
+        bd_release(mydb)
 
 
 def put_to_bd(sql, params=None):
+    mydb = None
     try:
         mydb = bd_connect()
         cursor = mydb.cursor(dictionary=True)
         cursor.execute(sql, params)
         mydb.commit()
         cursor.close()
-        mydb.close()
         return True
     except Exception as e:
         print(f'Ошибка: {e}')
         return False
+    finally:
+        bd_release(mydb)
+
+
+def put_many_to_bd(statements):
+    """Несколько запросов (sql, params) в одной транзакции: либо все, либо ни одного."""
+    mydb = None
+    try:
+        mydb = bd_connect()
+        cursor = mydb.cursor(dictionary=True)
+        for sql, params in statements:
+            cursor.execute(sql, params)
+        mydb.commit()
+        cursor.close()
+        return True
+    except Exception as e:
+        print(f'Ошибка: {e}')
+        if mydb is not None:
+            try:
+                mydb.rollback()
+            except mysql.connector.Error as err:
+                print(f'Ошибка отката транзакции: {err}')
+        return False
+    finally:
+        bd_release(mydb)
+
+
+def ping():
+    """Доступна ли база: отличает её простой от ошибок в конкретных данных."""
+    return get_from_bd("SELECT 1 AS ok", one_row=True) is not None
 
 
 def get_from_bd(sql, params=None, one_row=False):
+    mydb = None
     try:
         mydb = bd_connect()
         cursor = mydb.cursor(dictionary=True)
@@ -192,7 +702,6 @@ def get_from_bd(sql, params=None, one_row=False):
         rows = cursor.fetchall()
         mydb.commit()
         cursor.close()
-        mydb.close()
     except Exception as e:
         print(f'Ошибка: {e}')
     else:
@@ -202,25 +711,107 @@ def get_from_bd(sql, params=None, one_row=False):
             return rows
         else:
             return None
+    finally:
+        bd_release(mydb)
+
+
+# Пул соединений с MySQL: одно TCP-соединение + авторизация на несколько запросов
+DB_POOL_NAME = os.getenv('DB_POOL_NAME', 'quiz_pool')
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '10'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '5'))
+DB_CONNECT_ATTEMPTS = 6
+
+_pool = None
+_pool_lock = Lock()
+pool_stats = {
+    "checkouts": 0,
+    "in_use": 0,
+    "waits": 0,
+    "timeouts": 0,
+    "health_check_failures": 0,
+    "max_wait_ms": 0.0,
+}
+
+
+def get_pool():
+    global _pool
+    if _pool is not None:
+        return _pool
+    with _pool_lock:
+        if _pool is not None:
+            return _pool
+        k = 0
+        while k < DB_CONNECT_ATTEMPTS:
+            try:
+                _pool = pooling.MySQLConnectionPool(
+                    pool_name=DB_POOL_NAME,
+                    pool_size=DB_POOL_SIZE,
+                    pool_reset_session=True,
+                    host=os.getenv('DB_HOST', "host.docker.internal"),
+                    user=os.getenv('DB_USER'),
+                    port=os.getenv('DB_PORT'),
+                    password=os.getenv('DB_PASSWORD'),
+                    database=os.getenv('DB_DATABASE')
+                )
+            except mysql.connector.Error as err:
+                print(f"Ошибка подключения к базе данных: {err}")
+                k += 1
+            else:
+                return _pool
+    return None
+
+
+def get_pool_stats():
+    stats = dict(pool_stats)
+    stats["pool_size"] = DB_POOL_SIZE
+    # Свободные соединения считаем по своим счётчикам, не заглядывая во внутренности пула
+    stats["available"] = DB_POOL_SIZE - pool_stats["in_use"] if _pool else 0
+    return stats
 
 
 def bd_connect():
-    k = 0
-    while k <= 5:
+    pool = get_pool()
+    if pool is None:
+        return None
+    started = time.monotonic()
+    waited = False
+    while True:
         try:
-            mydb = mysql.connector.connect(
-                host=os.getenv('DB_HOST', "host.docker.internal"),
-                user=os.getenv('DB_USER'),
-                port=os.getenv('DB_PORT'),
-                password=os.getenv('DB_PASSWORD'),
-                database=os.getenv('DB_DATABASE')
-            )
+            mydb = pool.get_connection()
+        except pooling.PoolError as err:
+            # Пул исчерпан — ждём, пока другой запрос вернёт соединение
+            if time.monotonic() - started >= DB_POOL_TIMEOUT:
+                pool_stats["timeouts"] += 1
+                print(f"Ошибка подключения к базе данных: {err}")
+                return None
+            waited = True
+            time.sleep(0.01)
+            continue
         except mysql.connector.Error as err:
+            # get_connection() проверяет соединение (ping) и переподключает его
+            pool_stats["health_check_failures"] += 1
             print(f"Ошибка подключения к базе данных: {err}")
-            k += 1
-        else:
-            return mydb
-    return None
+            return None
+        break
+    if waited:
+        pool_stats["waits"] += 1
+        wait_ms = (time.monotonic() - started) * 1000
+        pool_stats["max_wait_ms"] = max(pool_stats["max_wait_ms"], wait_ms)
+    pool_stats["checkouts"] += 1
+    pool_stats["in_use"] += 1
+    return mydb
+
+
+def bd_release(mydb):
+    if mydb is None:
+        return
+    pool_stats["in_use"] -= 1
+    try:
+        # Для соединения из пула close() возвращает его обратно в пул
+        mydb.close()
+    except mysql.connector.Error as err:
+        print(f"Ошибка возврата соединения в пул: {err}")
+
 
 # list_cinema = []
 
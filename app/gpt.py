@@ -3,14 +3,63 @@ import os
 import uuid
 import re
 import json
+import time
+from collections import OrderedDict
+from dataclasses import replace
+from threading import Condition, Event, Lock
 from app.models import Question
 import random
 
+# Жёсткие ограничения по времени на запрос к LLM
+GPT_TIMEOUT = float(os.getenv('GPT_TIMEOUT', '20'))
+GPT_STREAM_DEADLINE = float(os.getenv('GPT_STREAM_DEADLINE', '60'))
+GPT_SLOW_CALL = float(os.getenv('GPT_SLOW_CALL', '15'))
+
 ai_client = OpenAI(
     api_key=os.getenv('API_KEY'),
-    base_url=os.getenv('BASE_URL')
+    base_url=os.getenv('BASE_URL'),
+    timeout=GPT_TIMEOUT,
+    max_retries=0
 )
 
+# Автомат-предохранитель: после GPT_BREAKER_THRESHOLD неудачных или медленных
+# вызовов подряд LLM не вызывается GPT_BREAKER_COOLDOWN секунд,
+# затем пропускается один пробный вызов
+GPT_BREAKER_THRESHOLD = int(os.getenv('GPT_BREAKER_THRESHOLD', '3'))
+GPT_BREAKER_COOLDOWN = float(os.getenv('GPT_BREAKER_COOLDOWN', '60'))
+breaker = {"failures": 0, "opened_at": None, "trial_at": None}
+_breaker_lock = Lock()
+
+
+def circuit_open(take_trial=True):
+    """take_trial=False — только проверить состояние, не занимая пробный вызов."""
+    with _breaker_lock:
+        if breaker["opened_at"] is None:
+            return False
+        now = time.monotonic()
+        if now - breaker["opened_at"] < GPT_BREAKER_COOLDOWN:
+            return True
+        # Пробный вызов уже идёт (или его результат ещё не записан)
+        if breaker["trial_at"] is not None and now - breaker["trial_at"] < GPT_STREAM_DEADLINE:
+            return True
+        # Время ожидания вышло — пропускаем один пробный вызов
+        if take_trial:
+            breaker["trial_at"] = now
+        return False
+
+
+def _record_call(success, elapsed):
+    with _breaker_lock:
+        if success and elapsed <= GPT_SLOW_CALL:
+            breaker.update(failures=0, opened_at=None, trial_at=None)
+            return
+        breaker["failures"] += 1
+        breaker["trial_at"] = None
+        if breaker["failures"] >= GPT_BREAKER_THRESHOLD or breaker["opened_at"] is not None:
+            if breaker["opened_at"] is None:
+                print(f"LLM недоступен: {breaker['failures']} неудачных вызовов подряд")
+            breaker["opened_at"] = time.monotonic()
+
 
 def gpt_request(system, text):
     messages = [
@@ -31,13 +80,144 @@ def gpt_request(system, text):
     return text
 
 
-def get_gpt_questions(count_questions, category_ids):
+def is_valid_question(question):
+    if not isinstance(question, dict):
+        return False
+    options = question.get('options')
+    if not question.get('text') or not isinstance(options, list) or len(options) < 2:
+        return False
+    if question.get('correct_answer') not in options:
+        return False
+    return isinstance(question.get('time_limit'), int) and question['time_limit'] > 0
+
+
+GPT_SYSTEM_PROMPT = "Необходимо придумать n вопросов на тематики: topics по запросу пользователей. Вернуть нужно только список словарей в формате [{'text': (Текст вопроса),'options': {[(ответ_1), (ответ_2), (ответ_3), (ответ_4)]}, 'correct_answer': (правильный ответ), 'time_limit': (Ограничение времени на вопрос от 30 до 60)}]. Делай интересные и уникальные вопросы. Вопросы не должны быть банальными"
+
+
+def _build_prompt(count_questions, category_ids):
     if len(category_ids) == 0:
-        system = "Необходимо придумать n вопросов на тематики: topics по запросу пользователей. Вернуть нужно только список словарей в формате [{'text': (Текст вопроса),'options': {[(ответ_1), (ответ_2), (ответ_3), (ответ_4)]}, 'correct_answer': (правильный ответ), 'time_limit': (Ограничение времени на вопрос от 30 до 60)}]. Делай интересные и уникальные вопросы. Вопросы не должны быть банальными"
         user_text = f"n = {count_questions}, topics = Любая тематика на твое усмотрение. Делай интересные и уникальные вопросы"
     else:
-        system = "Необходимо придумать n вопросов на тематики: topics по запросу пользователей. Вернуть нужно только список словарей в формате [{'text': (Текст вопроса),'options': {[(ответ_1), (ответ_2), (ответ_3), (ответ_4)]}, 'correct_answer': (правильный ответ), 'time_limit': (Ограничение времени на вопрос от 30 до 60)}]. Делай интересные и уникальные вопросы. Вопросы не должны быть банальными"
         user_text = f"n = {count_questions}, topics = {category_ids}"
+    return GPT_SYSTEM_PROMPT, user_text
+
+
+def _make_question(question):
+    options = question['options']
+    random.shuffle(options)
+    return Question(id=str(uuid.uuid4()),
+                    text=question['text'],
+                    options=options,
+                    correct_answer=question['correct_answer'],
+                    time_limit=question['time_limit'],
+                    category_id=os.getenv('GPT_CATEGORY_ID'))
+
+
+# Кэш недавних генераций: нормализованные темы -> (время, вопросы).
+# Одинаковые одновременные запросы ждут одну генерацию (singleflight).
+GPT_CACHE_SIZE = int(os.getenv('GPT_CACHE_SIZE', '64'))
+GPT_CACHE_TTL = int(os.getenv('GPT_CACHE_TTL', '600'))
+_cache = OrderedDict()
+_cache_lock = Lock()
+_inflight = {}
+_inflight_lock = Lock()
+cache_stats = {"hits": 0, "misses": 0, "coalesced": 0}
+
+
+class _InflightCall:
+    def __init__(self):
+        self.event = Event()
+        self.result = None
+
+
+def _topics_key(category_ids):
+    return tuple(sorted({str(topic).strip().lower() for topic in category_ids}))
+
+
+def _copy_questions(questions, count=None):
+    """Копии вопросов с новыми id и перемешанными вариантами — для разных комнат."""
+    questions = random.sample(questions, min(count or len(questions), len(questions)))
+    return [replace(q, id=str(uuid.uuid4()), options=random.sample(q.options, len(q.options))) for q in questions]
+
+
+def get_cached_questions(count_questions, category_ids):
+    key = _topics_key(category_ids)
+    with _cache_lock:
+        entry = _cache.get(key)
+        if entry is None or time.monotonic() - entry[0] > GPT_CACHE_TTL:
+            _cache.pop(key, None)
+            cache_stats["misses"] += 1
+            return None
+        if len(entry[1]) < count_questions:
+            cache_stats["misses"] += 1
+            return None
+        _cache.move_to_end(key)
+        cache_stats["hits"] += 1
+        questions = entry[1]
+    return _copy_questions(questions, count_questions)
+
+
+def cache_questions(category_ids, questions):
+    if not questions:
+        return
+    key = _topics_key(category_ids)
+    with _cache_lock:
+        entry = _cache.get(key)
+        # Храним самую крупную недавнюю генерацию по темам
+        if entry is None or len(entry[1]) <= len(questions) or time.monotonic() - entry[0] > GPT_CACHE_TTL:
+            _cache[key] = (time.monotonic(), list(questions))
+        _cache.move_to_end(key)
+        while len(_cache) > GPT_CACHE_SIZE:
+            _cache.popitem(last=False)
+
+
+def get_gpt_questions(count_questions, category_ids, use_cache=True):
+    if use_cache:
+        cached = get_cached_questions(count_questions, category_ids)
+        if cached:
+            return {'success': True, 'questions': cached}
+    if circuit_open():
+        return {'success': False, 'questions': None}
+
+    flight_key = (_topics_key(category_ids), count_questions, use_cache)
+    with _inflight_lock:
+        call = _inflight.get(flight_key)
+        leader = call is None
+        if leader:
+            call = _inflight[flight_key] = _InflightCall()
+    if not leader:
+        # Такой же запрос уже выполняется — ждём его результат
+        cache_stats["coalesced"] += 1
+        call.event.wait()
+        result = call.result
+        if not result['success']:
+            return result
+        return {'success': True, 'questions': _copy_questions(result['questions'])}
+
+    try:
+        call.result = _request_gpt_questions(count_questions, category_ids)
+        # Без кэша генерируются вопросы для пула: в кэше они потом повторились бы в комнатах
+        if call.result['success'] and use_cache:
+            cache_questions(category_ids, call.result['questions'])
+        return {'success': call.result['success'],
+                'questions': _copy_questions(call.result['questions']) if call.result['success'] else None}
+    finally:
+        if call.result is None:
+            call.result = {'success': False, 'questions': None}
+        with _inflight_lock:
+            _inflight.pop(flight_key, None)
+        call.event.set()
+
+
+def _request_gpt_questions(count_questions, category_ids):
+    started = time.monotonic()
+    result = _parse_gpt_questions(count_questions, category_ids)
+    _record_call(result['success'], time.monotonic() - started)
+    return result
+
+
+def _parse_gpt_questions(count_questions, category_ids):
+    system, user_text = _build_prompt(count_questions, category_ids)
     try:
         data = gpt_request(system, user_text)
         pattern = r'\[[\s\S]*\]'
@@ -48,18 +228,172 @@ def get_gpt_questions(count_questions, category_ids):
         questions = []
         if data:
             for question in data:
-                options = question['options']
-                random.shuffle(options)
-                questions.append(
-                    Question(id=str(uuid.uuid4()),
-                             text=question['text'],
-                             options=options,
-                             correct_answer=question['correct_answer'],
-                             time_limit=question['time_limit'],
-                             category_id=os.getenv('GPT_CATEGORY_ID')))
-            return {'success': True, 'questions': questions}
+                if not is_valid_question(question):
+                    continue
+                questions.append(_make_question(question))
+            return {'success': bool(questions), 'questions': questions or None}
         else:
             return {'success': False, 'questions': None}
     except Exception as e:
         print(e)
         return {'success': False, 'questions': None}
+
+
+def gpt_stream_request(system, text):
+    messages = [
+        {'role': 'system',
+         'content': system
+         },
+        {
+            'role': 'user',
+            'content': text
+        }]
+    response = ai_client.chat.completions.create(
+        model='gemini-2.5-flash-lite',
+        messages=messages,
+        temperature=1,
+        stream=True
+    )
+    try:
+        for chunk in response:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+    finally:
+        # Генерацию могут прервать раньше — HTTP-соединение закрываем сразу, а не при сборке мусора
+        response.close()
+
+
+def _until_deadline(chunks, started, state):
+    """Отдаёт куски ответа, пока не вышло GPT_STREAM_DEADLINE; паузы между кусками ограничивает GPT_TIMEOUT клиента."""
+    for chunk in chunks:
+        if time.monotonic() - started > GPT_STREAM_DEADLINE:
+            state["expired"] = True
+            return
+        yield chunk
+
+
+def iter_json_objects(chunks):
+    """Достаёт объекты из JSON-массива по мере того, как модель их дописывает."""
+    started = False
+    depth = 0
+    in_string = False
+    escape = False
+    buf = []
+    for chunk in chunks:
+        for ch in chunk:
+            if not started:
+                started = ch == '['
+                continue
+            if depth:
+                buf.append(ch)
+            if in_string:
+                if escape:
+                    escape = False
+                elif ch == '\\':
+                    escape = True
+                elif ch == '"':
+                    in_string = False
+            elif ch == '"':
+                in_string = True
+            elif ch == '{':
+                if depth == 0:
+                    buf = [ch]
+                depth += 1
+            elif ch == '}' and depth:
+                depth -= 1
+                if depth == 0:
+                    yield ''.join(buf)
+
+
+def stream_gpt_questions(count_questions, category_ids):
+    """Генератор вопросов: каждый вопрос отдаётся, как только модель его закончила."""
+    if circuit_open():
+        return
+    system, user_text = _build_prompt(count_questions, category_ids)
+    generated = []
+    started = time.monotonic()
+    first_question_after = None
+    success = False
+    state = {"expired": False}
+    chunks = gpt_stream_request(system, user_text)
+    try:
+        for raw in iter_json_objects(_until_deadline(chunks, started, state)):
+            try:
+                question = json.loads(raw)
+            except ValueError:
+                continue
+            if is_valid_question(question):
+                question = _make_question(question)
+                if first_question_after is None:
+                    first_question_after = time.monotonic() - started
+                generated.append(question)
+                yield question
+        if state["expired"]:
+            print("Генерация вопросов не уложилась в отведённое время")
+        else:
+            success = bool(generated)
+    except GeneratorExit:
+        # Потребителю хватило вопросов — генерация прошла успешно
+        success = bool(generated)
+        raise
+    except Exception as e:
+        print(e)
+    finally:
+        chunks.close()
+        # Для потока «медленно» — это долгое ожидание первого вопроса
+        _record_call(success, first_question_after if success else time.monotonic() - started)
+        cache_questions(category_ids, generated)
+
+
+class _InflightStream:
+    def __init__(self):
+        self.condition = Condition()
+        self.questions = []
+        self.done = False
+
+
+def stream_shared_gpt_questions(count_questions, category_ids):
+    """Как stream_gpt_questions, но одинаковые одновременные генерации (темы и число
+    вопросов) идут одним потоком LLM: остальные комнаты получают копии вопросов по мере готовности."""
+    flight_key = ('stream', _topics_key(category_ids), count_questions)
+    with _inflight_lock:
+        call = _inflight.get(flight_key)
+        leader = call is None
+        if leader:
+            call = _inflight[flight_key] = _InflightStream()
+    if not leader:
+        cache_stats["coalesced"] += 1
+        yield from _follow_stream(call)
+        return
+
+    stream = stream_gpt_questions(count_questions, category_ids)
+    try:
+        for question in stream:
+            with call.condition:
+                call.questions.append(question)
+                call.condition.notify_all()
+            yield question
+    finally:
+        stream.close()
+        with _inflight_lock:
+            _inflight.pop(flight_key, None)
+        with call.condition:
+            call.done = True
+            call.condition.notify_all()
+
+
+def _follow_stream(call):
+    sent = 0
+    deadline = time.monotonic() + GPT_STREAM_DEADLINE + GPT_TIMEOUT
+    while True:
+        with call.condition:
+            while sent == len(call.questions) and not call.done:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return
+                call.condition.wait(left)
+            if sent == len(call.questions):
+                return
+            questions = call.questions[sent:]
+        sent += len(questions)
+        yield from _copy_questions(questions)
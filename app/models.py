@@ -51,3 +51,4 @@ class Room:
     leaderboard: List[dict] = field(default_factory=list)
     max_players: int = 10
     room_code: Optional[str] = None
+    large: bool = False
@@ -0,0 +1,103 @@
+import os
+import random
+import uuid
+
+from app import redis_storage
+from app.gpt import GPT_TIMEOUT, get_gpt_questions, get_cached_questions
+
+# Темы без выбранных категорий
+ANY_TOPIC = "any"
+# Фоновый воркер пополняет пул темы, когда в нём меньше GPT_POOL_MIN вопросов
+GPT_POOL_MIN = int(os.getenv('GPT_POOL_MIN', '50'))
+GPT_POOL_BATCH = int(os.getenv('GPT_POOL_BATCH', '20'))
+GPT_POOL_REFILL_INTERVAL = float(os.getenv('GPT_POOL_REFILL_INTERVAL', '5'))
+# Блокировка темы продлевается перед каждой пачкой и должна пережить один запрос к LLM
+GPT_POOL_REFILL_LOCK_TTL = int(os.getenv('GPT_POOL_REFILL_LOCK_TTL', str(int(GPT_TIMEOUT * 2) + 30)))
+
+
+def _generate(count, topic):
+    # Для пула нужны новые вопросы, а не повтор недавней генерации из кэша
+    return get_gpt_questions(count, [] if topic == ANY_TOPIC else [topic], use_cache=False)
+
+
+def register_topics(topics):
+    redis_storage.add_gpt_pool_topics([ANY_TOPIC, *topics])
+
+
+def take_questions(count_questions, topics, generate_missing=True):
+    """Вопросы для GPT-комнаты из пула.
+
+    Недостающие генерируются сразу, либо, при generate_missing=False,
+    возвращаются числом в pending — их догенерирует комната в фоне.
+    """
+    requested_topics = topics
+    topics = topics or [ANY_TOPIC]
+    redis_storage.add_gpt_pool_topics(topics)
+
+    # Делим вопросы между темами поровну
+    counts = {topic: count_questions // len(topics) for topic in topics}
+    for topic in topics[:count_questions % len(topics)]:
+        counts[topic] += 1
+    questions = []
+    for taken in redis_storage.pop_gpt_pool_questions(counts).values():
+        questions.extend(taken)
+
+    # Если в пуле одной темы не хватило — добираем из остальных
+    missing = count_questions - len(questions)
+    for topic in topics:
+        if missing <= 0:
+            break
+        taken = redis_storage.pop_gpt_pool_questions({topic: missing}).get(topic, [])
+        questions.extend(taken)
+        missing -= len(taken)
+
+    if missing > 0:
+        print(f"В пуле GPT-вопросов не хватило {missing} вопросов для тем {topics}")
+        # Недавняя генерация по тем же темам — перемешиваем и берём нужное число
+        cached = get_cached_questions(missing, requested_topics)
+        if cached:
+            questions.extend(cached)
+            missing = 0
+    if missing > 0 and generate_missing:
+        generated = get_gpt_questions(missing, requested_topics)
+        if generated['success']:
+            questions.extend(generated['questions'])
+        missing = 0
+
+    if not questions and not missing:
+        return {'success': False, 'questions': None}
+    for question in questions:
+        question.id = str(uuid.uuid4())
+        random.shuffle(question.options)
+    random.shuffle(questions)
+    return {'success': True, 'questions': questions, 'pending': missing, 'topics': requested_topics}
+
+
+def refill_topic(topic, token):
+    while redis_storage.get_gpt_pool_size(topic) < GPT_POOL_MIN:
+        if not redis_storage.renew_gpt_pool_refill(topic, token, GPT_POOL_REFILL_LOCK_TTL):
+            print(f"Блокировка пополнения темы {topic} потеряна — пополнение прервано")
+            return
+        generated = _generate(GPT_POOL_BATCH, topic)
+        if not generated['success']:
+            print(f"Не удалось пополнить пул GPT-вопросов для темы {topic}")
+            return
+        redis_storage.push_gpt_pool_questions(topic, generated['questions'])
+
+
+def refill_loop(sleep):
+    # Пополняет пулы всех известных тем; одну тему пополняет только один воркер
+    while True:
+        try:
+            for topic in redis_storage.get_gpt_pool_topics():
+                if redis_storage.get_gpt_pool_size(topic) >= GPT_POOL_MIN:
+                    continue
+                token = redis_storage.try_acquire_gpt_pool_refill(topic, GPT_POOL_REFILL_LOCK_TTL)
+                if token:
+                    try:
+                        refill_topic(topic, token)
+                    finally:
+                        redis_storage.release_gpt_pool_refill(topic, token)
+        except Exception as e:
+            print(f"Ошибка пополнения пула GPT-вопросов: {e}")
+        sleep(GPT_POOL_REFILL_INTERVAL)
@@ -1,19 +1,44 @@
 import redis
 import pickle
+import json
 import os
+import hashlib
+import uuid
+from datetime import datetime
+from enum import Enum
+
+from app.models import Room, Player, Question, RoomStatus
 
 # Подключение к Redis
 r = redis.Redis(host=os.getenv('REDIS_HOST'), port=int(os.getenv('REDIS_PORT')), db=0, decode_responses=False)
 
+# Время жизни ключей комнаты; продлевается при активности (вход, старт, новый вопрос)
+ROOM_TTL = int(os.getenv('ROOM_TTL', str(2 * 60 * 60)))
+# Завершённая игра хранится недолго — только чтобы показать результаты
+FINISHED_ROOM_TTL = int(os.getenv('FINISHED_ROOM_TTL', str(10 * 60)))
+
+
+def _sid_keys(request_sid):
+    return f"sid_user:{request_sid}", f"sid_room:{request_sid}"
+
 
 def save_request_sid(request_sid, user_id, room_id):
-    r.set(f"sid_user:{request_sid}", user_id.encode('utf-8'))
-    r.set(f"sid_room:{request_sid}", room_id.encode('utf-8'))
+    # sid запоминается в комнате, чтобы touch_room продлевал и его ключи
+    pipe = r.pipeline()
+    pipe.set(f"sid_user:{request_sid}", user_id.encode('utf-8'), ex=ROOM_TTL)
+    pipe.set(f"sid_room:{request_sid}", room_id.encode('utf-8'), ex=ROOM_TTL)
+    pipe.sadd(_sids_key(room_id), request_sid)
+    pipe.expire(_sids_key(room_id), ROOM_TTL)
+    pipe.execute()
 
 
 def delete_request_sid(request_sid):
-    r.delete(f"sid_user:{request_sid}")
-    r.delete(f"sid_room:{request_sid}")
+    room_id = r.get(f"sid_room:{request_sid}")
+    pipe = r.pipeline()
+    pipe.delete(*_sid_keys(request_sid))
+    if room_id:
+        pipe.srem(_sids_key(_decode(room_id)), request_sid)
+    pipe.execute()
 
 
 def get_request_sid_data(request_sid):
@@ -24,23 +49,541 @@ def get_request_sid_data(request_sid):
     return None
 
 
+# Комната хранится по частям, чтобы обновлять только изменившиеся поля:
+#   room:{id}:meta            hash — статус, владелец, код, таймеры
+#   room:{id}:players         list — user_id игроков в порядке входа
+#   room:{id}:player:{user}   hash — поля одного игрока
+#   room:{id}:questions       list — вопросы в JSON
+#   room:{id}:scores          zset — очки игроков (таблица лидеров)
+#   room:{id}:sids            set  — sid подключений Socket.IO к комнате
+#   room:{id}:batch:{event}   list — события большой комнаты, ждущие пакетной рассылки
+# Старый формат (pickle всей комнаты в room:{id}) мигрируется при чтении.
+
+
+def _meta_key(room_id):
+    return f"room:{room_id}:meta"
+
+
+def _players_key(room_id):
+    return f"room:{room_id}:players"
+
+
+def _player_key(room_id, user_id):
+    return f"room:{room_id}:player:{user_id}"
+
+
+def _questions_key(room_id):
+    return f"room:{room_id}:questions"
+
+
+def _scores_key(room_id):
+    return f"room:{room_id}:scores"
+
+
+def _sids_key(room_id):
+    return f"room:{room_id}:sids"
+
+
+def _batch_key(room_id, event):
+    return f"room:{room_id}:batch:{event}"
+
+
+# Счётчики буферизованной рассылки, общие для всех воркеров: events — событий положено
+# в буферы (считает скрипт ответа), batches — разослано пачек (считает drain_batch)
+BROADCAST_STATS_KEY = "stats:broadcast"
+
+
+DEADLINES_KEY = "room_deadlines"
+
+
+def _legacy_room_key(room_id):
+    return f"room:{room_id}"
+
+
+def _decode(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+def _decode_hash(data):
+    return {_decode(k): _decode(v) for k, v in data.items()}
+
+
+def _to_str(value):
+    if value is None:
+        return ""
+    if isinstance(value, Enum):
+        return str(value.value)
+    if isinstance(value, datetime):
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+    return str(value)
+
+
+def _or_none(value):
+    return value if value else None
+
+
+def _player_to_hash(player):
+    return {
+        "user_id": player.user_id,
+        "username": player.username,
+        "score": player.score,
+        "correct": player.correct,
+        "answered": int(player.answered),
+        "answer": player.answer or "",
+        "joined_at": player.joined_at.isoformat() if player.joined_at else "",
+    }
+
+
+def _player_from_hash(data):
+    data = _decode_hash(data)
+    if not data:
+        return None
+    return Player(
+        user_id=data["user_id"],
+        username=data["username"],
+        score=int(data.get("score", 0)),
+        correct=int(data.get("correct", 0)),
+        answered=data.get("answered") == "1",
+        answer=data.get("answer") or None,
+        joined_at=datetime.fromisoformat(data["joined_at"]) if data.get("joined_at") else None,
+    )
+
+
+def _question_to_json(question):
+    return json.dumps({
+        "id": question.id,
+        "text": question.text,
+        "options": question.options,
+        "correct_answer": question.correct_answer,
+        "time_limit": question.time_limit,
+        "category_id": question.category_id,
+    }, ensure_ascii=False)
+
+
+def _question_from_json(data):
+    return Question(**json.loads(data))
+
+
+def _room_meta(room):
+    return {
+        "room_id": room.room_id,
+        "owner": room.owner.user_id if room.owner else "",
+        "owner_username": room.owner.username if room.owner else "",
+        "status": RoomStatus(room.status).value,
+        "current_question_index": room.current_question_index,
+        "timer_start": _to_str(room.timer_start),
+        "timer_end": _to_str(room.timer_end),
+        "max_players": room.max_players,
+        "room_code": _to_str(room.room_code),
+        "large": int(room.large),
+    }
+
+
 def save_room(room_id, room):
-    r.set(f"room:{room_id}", pickle.dumps(room))
+    """Полная запись комнаты. Для частичных обновлений — функции ниже."""
+    old_players = r.lrange(_players_key(room_id), 0, -1)
+    pipe = r.pipeline()
+    pipe.delete(_legacy_room_key(room_id), _players_key(room_id), _questions_key(room_id), _scores_key(room_id),
+                *[_player_key(room_id, _decode(user_id)) for user_id in old_players])
+    pipe.hset(_meta_key(room_id), mapping=_room_meta(room))
+    for player in room.players.values():
+        pipe.rpush(_players_key(room_id), player.user_id)
+        pipe.hset(_player_key(room_id, player.user_id), mapping=_player_to_hash(player))
+    if room.players:
+        pipe.zadd(_scores_key(room_id), {player.user_id: player.score for player in room.players.values()})
+    if room.questions:
+        pipe.rpush(_questions_key(room_id), *[_question_to_json(q) for q in room.questions])
+    pipe.execute()
 
 
 def get_room(room_id):
-    data = r.get(f"room:{room_id}")
-    if data:
-        return pickle.loads(data)
-    return None
+    pipe = r.pipeline()
+    pipe.hgetall(_meta_key(room_id))
+    pipe.lrange(_players_key(room_id), 0, -1)
+    pipe.lrange(_questions_key(room_id), 0, -1)
+    meta, user_ids, questions = pipe.execute()
+    if not meta:
+        return _migrate_legacy_room(room_id)
+    meta = _decode_hash(meta)
+    players = get_players(room_id, [_decode(user_id) for user_id in user_ids])
+    return _room_from_parts(meta, players, [_question_from_json(q) for q in questions])
+
+
+def _room_from_parts(meta, players, questions):
+    room = Room(
+        room_id=meta["room_id"],
+        status=RoomStatus(meta["status"]),
+        players={player.user_id: player for player in players},
+        questions=questions,
+        current_question_index=int(meta["current_question_index"]),
+        timer_start=_or_none(meta.get("timer_start")),
+        timer_end=_or_none(meta.get("timer_end")),
+        max_players=int(meta["max_players"]),
+        room_code=_or_none(meta.get("room_code")),
+        large=meta.get("large") == "1",
+    )
+    room.owner = owner_from_meta(meta, room.players)
+    return room
+
+
+def owner_from_meta(meta, players):
+    """Владелец комнаты по meta; players — словарь user_id -> Player."""
+    owner_id = meta.get("owner")
+    if not owner_id:
+        return None
+    return players.get(owner_id) or Player(user_id=owner_id, username=meta.get("owner_username", ""))
+
+
+def _migrate_legacy_room(room_id):
+    data = r.get(_legacy_room_key(room_id))
+    if not data:
+        return None
+    room = pickle.loads(data)
+    save_room(room_id, room)
+    return room
+
+
+def migrate_pickled_rooms():
+    """Переводит все комнаты, сохранённые pickle-ом целиком, в новый формат."""
+    migrated = 0
+    for key in r.scan_iter(match="room:*", _type="string"):
+        room_id = _decode(key)[len("room:"):]
+        if _migrate_legacy_room(room_id):
+            migrated += 1
+    return migrated
+
+
+def room_exists(room_id):
+    return bool(r.exists(_meta_key(room_id)) or r.exists(_legacy_room_key(room_id)))
+
+
+def get_room_meta(room_id):
+    meta = r.hgetall(_meta_key(room_id))
+    if not meta and _migrate_legacy_room(room_id):
+        meta = r.hgetall(_meta_key(room_id))
+    return _decode_hash(meta) if meta else None
+
+
+def set_room_fields(room_id, **fields):
+    r.hset(_meta_key(room_id), mapping={k: _to_str(v) for k, v in fields.items()})
+
+
+def get_room_status(room_id):
+    status = r.hget(_meta_key(room_id), "status")
+    if status is None:
+        meta = get_room_meta(room_id)
+        return RoomStatus(meta["status"]) if meta else None
+    return RoomStatus(_decode(status))
+
+
+def set_room_status(room_id, status):
+    r.hset(_meta_key(room_id), "status", RoomStatus(status).value)
+
+
+def set_room_owner(room_id, player):
+    r.hset(_meta_key(room_id), mapping={"owner": player.user_id, "owner_username": player.username})
+
+
+def get_question(room_id, pos):
+    if pos is None or pos < 0:
+        return None
+    data = r.lindex(_questions_key(room_id), pos)
+    return _question_from_json(data) if data else None
+
+
+def get_questions_count(room_id):
+    return r.llen(_questions_key(room_id))
+
+
+def append_room_question(room_id, question):
+    # Список мог только что появиться (комната создана без вопросов) — сразу даём ему TTL
+    pipe = r.pipeline()
+    pipe.rpush(_questions_key(room_id), _question_to_json(question))
+    pipe.expire(_questions_key(room_id), ROOM_TTL)
+    return pipe.execute()[0]
+
+
+def get_room_questions(room_id):
+    return [_question_from_json(data) for data in r.lrange(_questions_key(room_id), 0, -1)]
+
+
+def set_room_question(room_id, pos, question):
+    r.lset(_questions_key(room_id), pos, _question_to_json(question))
+
+
+def get_player(room_id, user_id):
+    return _player_from_hash(r.hgetall(_player_key(room_id, user_id)))
+
+
+def get_players(room_id, user_ids=None):
+    if user_ids is None:
+        user_ids = [_decode(user_id) for user_id in r.lrange(_players_key(room_id), 0, -1)]
+    pipe = r.pipeline()
+    for user_id in user_ids:
+        pipe.hgetall(_player_key(room_id, user_id))
+    players = [_player_from_hash(data) for data in pipe.execute()] if user_ids else []
+    return [player for player in players if player]
+
+
+def get_player_ids(room_id, limit=None):
+    end = -1 if limit is None else limit - 1
+    return [_decode(user_id) for user_id in r.lrange(_players_key(room_id), 0, end)]
+
+
+def get_players_count(room_id):
+    return r.llen(_players_key(room_id))
+
+
+def save_player(room_id, player):
+    r.hset(_player_key(room_id, player.user_id), mapping=_player_to_hash(player))
+
+
+def add_player(room_id, player):
+    pipe = r.pipeline()
+    pipe.rpush(_players_key(room_id), player.user_id)
+    pipe.hset(_player_key(room_id, player.user_id), mapping=_player_to_hash(player))
+    pipe.zadd(_scores_key(room_id), {player.user_id: player.score})
+    pipe.execute()
+
+
+def remove_player(room_id, user_id):
+    _unmark_answered(room_id, user_id)
+    pipe = r.pipeline()
+    pipe.lrem(_players_key(room_id), 0, user_id)
+    pipe.delete(_player_key(room_id, user_id))
+    pipe.zrem(_scores_key(room_id), user_id)
+    pipe.execute()
+
+
+def reset_players_answers(room_id, reset_scores=False):
+    fields = {"answered": 0, "answer": ""}
+    if reset_scores:
+        fields.update({"score": 0, "correct": 0})
+    user_ids = [_decode(user_id) for user_id in r.lrange(_players_key(room_id), 0, -1)]
+    pipe = r.pipeline()
+    for user_id in user_ids:
+        pipe.hset(_player_key(room_id, user_id), mapping=fields)
+    if reset_scores and user_ids:
+        pipe.zadd(_scores_key(room_id), {user_id: 0 for user_id in user_ids})
+    pipe.execute()
+
+
+def _unmark_answered(room_id, user_id):
+    """Игрок уходит посреди вопроса — его ответ больше не учитывается в счётчике."""
+    if r.hget(_player_key(room_id, user_id), "answered") == b"1":
+        r.hincrby(_meta_key(room_id), "answered_count", -1)
+
+
+# Начало вопроса: время берётся из Redis, чтобы все воркеры считали его одинаково.
+# Сразу ставится дедлайн закрытия вопроса в общий планировщик.
+_START_QUESTION_SCRIPT = r.register_script("""
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local lim = math.max(tonumber(ARGV[1]) or 0, 0)
+redis.call('HSET', KEYS[1],
+    'status', 'question',
+    'question_started_at', now,
+    'question_time_limit', ARGV[1],
+    'question_correct_answer', ARGV[2],
+    'answered_count', 0,
+    'deadline_at', now + lim * 1000)
+redis.call('ZADD', KEYS[2], now + lim * 1000, ARGV[3])
+return now
+""")
+
+# Регистрация ответа и начисление очков одной атомарной операцией.
+# Возвращает {код, правильный ли ответ, начисленные очки, все ли ответили, большая ли комната,
+# размер буфера рассылки после добавления ответа (0 — не буферизуется)}
+_ANSWER_SCRIPT = r.register_script("""
+local status = redis.call('HGET', KEYS[1], 'status')
+if not status then return {-1, 0, 0, 0, 0, 0} end
+if status ~= 'question' then return {0, 0, 0, 0, 0, 0} end
+if redis.call('EXISTS', KEYS[2]) == 0 then return {-2, 0, 0, 0, 0, 0} end
+if redis.call('HGET', KEYS[2], 'answered') == '1' then return {-3, 0, 0, 0, 0, 0} end
+local started = tonumber(redis.call('HGET', KEYS[1], 'question_started_at') or '')
+if not started then return {-4, 0, 0, 0, 0, 0} end
+local lim = tonumber(redis.call('HGET', KEYS[1], 'question_time_limit') or '0') or 0
+
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local past = (now - started) / 1000.0
+if lim > 0 and past > lim then return {0, 0, 0, 0, 0, 0} end
+
+redis.call('HSET', KEYS[2], 'answered', 1, 'answer', ARGV[1])
+local code = 1
+local correct = 0
+local points = 0
+if lim <= 0 then
+    -- без ограничения времени очки не начисляются, но ответ учитывается в счётчике
+    code = 2
+elseif ARGV[1] == redis.call('HGET', KEYS[1], 'question_correct_answer') then
+    correct = 1
+    local part = lim / 4.0
+    if past < part then
+        points = 60
+    elseif past < 2 * part then
+        points = 35
+    elseif past < 3 * part then
+        points = 20
+    else
+        points = 10
+    end
+    redis.call('HINCRBY', KEYS[2], 'correct', 1)
+    redis.call('HINCRBY', KEYS[2], 'score', points)
+    redis.call('ZINCRBY', KEYS[5], points, ARGV[3])
+end
+
+local all_answered = 0
+local answered = redis.call('HINCRBY', KEYS[1], 'answered_count', 1)
+if answered >= redis.call('LLEN', KEYS[3]) then
+    -- все ответили: переносим дедлайн закрытия вопроса на текущий момент
+    all_answered = 1
+    redis.call('HSET', KEYS[1], 'deadline_at', now)
+    redis.call('ZADD', KEYS[4], 'XX', now, ARGV[2])
+end
+local large = 0
+local batched = 0
+if redis.call('HGET', KEYS[1], 'large') == '1' then
+    -- большая комната: ответ сразу попадает в общий буфер рассылки вместе с новым счётом игрока
+    large = 1
+    local score = tonumber(redis.call('ZSCORE', KEYS[5], ARGV[3]) or '0')
+    batched = redis.call('RPUSH', KEYS[6], cjson.encode({user_id = ARGV[3], correct_answered = correct,
+                                                         score = score}))
+    redis.call('EXPIRE', KEYS[6], ARGV[4])
+    redis.call('HINCRBY', KEYS[7], 'events', 1)
+end
+return {code, correct, points, all_answered, large, batched}
+""")
+
+ANSWER_RESULTS = {
+    -1: "room_not_found",
+    -2: "user_not_in_room",
+    -3: "already_answered",
+    -4: "question_not_started",
+    0: "rejected",
+    1: "accepted",
+    2: "accepted_no_limit",
+}
+
+
+def start_question(room_id, question):
+    return _START_QUESTION_SCRIPT(keys=[_meta_key(room_id), DEADLINES_KEY],
+                                  args=[question.time_limit or 0, question.correct_answer, room_id])
+
+
+def register_answer(room_id, user_id, answer_text):
+    code, correct, points, all_answered, large, batched = _ANSWER_SCRIPT(
+        keys=[_meta_key(room_id), _player_key(room_id, user_id), _players_key(room_id), DEADLINES_KEY,
+              _scores_key(room_id), _batch_key(room_id, "answered"), BROADCAST_STATS_KEY],
+        args=["" if answer_text is None else answer_text, room_id, user_id, ROOM_TTL])
+    return {
+        "result": ANSWER_RESULTS[code],
+        "correct": bool(correct),
+        "points": points,
+        "all_answered": bool(all_answered),
+        "large": bool(large),
+        "batch_size": batched,
+    }
+
+
+def drain_batch(room_id, event):
+    """Забирает и очищает буфер событий комнаты — из любого воркера."""
+    pipe = r.pipeline()
+    pipe.lrange(_batch_key(room_id, event), 0, -1)
+    pipe.delete(_batch_key(room_id, event))
+    items = pipe.execute()[0]
+    if items:
+        r.hincrby(BROADCAST_STATS_KEY, "batches", 1)
+    return [json.loads(item) for item in items]
+
+
+def get_broadcast_stats():
+    stats = {"events": 0, "batches": 0}
+    stats.update((key, int(value)) for key, value in _decode_hash(r.hgetall(BROADCAST_STATS_KEY)).items())
+    # Каждое событие в буфере сэкономило по доставке каждому игроку комнаты, кроме одной общей рассылки
+    stats["messages_saved"] = stats["events"] - stats["batches"]
+    return stats
+
+
+def is_large_room(room_id):
+    return r.hget(_meta_key(room_id), "large") == b"1"
+
+
+def get_leaderboard(room_id, limit=None):
+    """Игроки по убыванию очков из sorted set; limit — только первые места."""
+    if not r.exists(_scores_key(room_id)):
+        # Комната создана до появления таблицы очков — заполняем её по игрокам
+        players = get_players(room_id)
+        if not players:
+            return []
+        r.zadd(_scores_key(room_id), {player.user_id: player.score for player in players})
+    entries = r.zrevrange(_scores_key(room_id), 0, -1 if limit is None else limit - 1, withscores=True)
+    pipe = r.pipeline()
+    for user_id, _ in entries:
+        pipe.hget(_player_key(room_id, _decode(user_id)), "username")
+    usernames = pipe.execute() if entries else []
+    return [{"user_id": _decode(user_id), "username": _decode(username), "score": int(score)}
+            for (user_id, score), username in zip(entries, usernames) if username is not None]
+
+
+def get_player_rank(room_id, user_id):
+    """Место игрока (с 1) за O(log n)."""
+    pipe = r.pipeline()
+    pipe.zrevrank(_scores_key(room_id), user_id)
+    pipe.zscore(_scores_key(room_id), user_id)
+    pipe.zcard(_scores_key(room_id))
+    rank, score, count = pipe.execute()
+    if rank is None:
+        return None
+    return {"user_id": user_id, "rank": rank + 1, "score": int(score), "players_count": count}
 
 
 def delete_room(room_id):
-    r.delete(f"room:{room_id}")
+    user_ids = r.lrange(_players_key(room_id), 0, -1)
+    r.delete(_legacy_room_key(room_id), _meta_key(room_id), _players_key(room_id), _questions_key(room_id),
+             _scores_key(room_id), _sids_key(room_id), _batch_key(room_id, "answered"),
+             *[_player_key(room_id, _decode(user_id)) for user_id in user_ids])
+
+
+# Счётчики выдачи кодов комнат, общие для всех воркеров: allocated, collisions, failures
+ROOM_CODE_STATS_KEY = "stats:room_codes"
 
+_CLAIM_ROOM_CODE_SCRIPT = r.register_script("""
+if redis.call('SET', KEYS[1], ARGV[1], 'NX', 'EX', ARGV[2]) then
+    redis.call('HINCRBY', KEYS[2], 'allocated', 1)
+    return 1
+end
+redis.call('HINCRBY', KEYS[2], 'collisions', 1)
+return 0
+""")
 
-def save_room_code(code, room_id):
-    r.set(f"code:{code}", room_id.encode('utf-8'))
+
+def claim_room_code(code, room_id):
+    """Занимает код, только если он свободен (SET NX) — чужую комнату не перезаписать."""
+    return bool(_CLAIM_ROOM_CODE_SCRIPT(keys=[f"code:{code}", ROOM_CODE_STATS_KEY], args=[room_id, ROOM_TTL]))
+
+
+def record_room_code_failure():
+    r.hincrby(ROOM_CODE_STATS_KEY, "failures", 1)
+
+
+def get_room_code_stats():
+    stats = {"allocated": 0, "collisions": 0, "failures": 0}
+    stats.update((key, int(value)) for key, value in _decode_hash(r.hgetall(ROOM_CODE_STATS_KEY)).items())
+    return stats
+
+
+_RELEASE_ROOM_CODE_SCRIPT = r.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+""")
+
+
+def release_room_code(code, room_id):
+    """Освобождает код, если он всё ещё принадлежит этой комнате."""
+    return bool(_RELEASE_ROOM_CODE_SCRIPT(keys=[f"code:{code}"], args=[room_id]))
 
 
 def get_room_id_by_code(code):
@@ -56,6 +599,10 @@ def set_quest_position(room_id, index):
     r.set(f"quest_pos:{room_id}", index)
 
 
+def init_quest_position(room_id):
+    r.set(f"quest_pos:{room_id}", -1, nx=True)
+
+
 def get_quest_position(room_id):
     pos = r.get(f"quest_pos:{room_id}")
     return int(pos) if pos else None
@@ -78,6 +625,843 @@ def get_active_rooms():
     return [room_id.decode('utf-8') for room_id in room_ids]
 
 
+# Индекс лобби: краткая сводка по каждой комнате в ожидании игроков
+#   lobby:{id}                   hash — владелец, код, число игроков, категории
+#   lobby_index                  zset — room_id по времени создания
+#   lobby_index:category:{cat}   zset — то же с фильтром по категории
+LOBBY_INDEX_KEY = "lobby_index"
+
+
+def _lobby_key(room_id):
+    return f"lobby:{room_id}"
+
+
+def _lobby_category_key(category_id):
+    return f"{LOBBY_INDEX_KEY}:category:{category_id}"
+
+
+_REFRESH_LOBBY_PLAYERS_SCRIPT = r.register_script("""
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('HSET', KEYS[1], 'player_count', redis.call('LLEN', KEYS[2]))
+    return 1
+end
+return 0
+""")
+
+
+def add_lobby_room(room, category_names, category_ids=None, question_count=None):
+    if category_ids is None:
+        category_ids = set(question.category_id for question in room.questions)
+    category_ids = sorted(category_ids)
+    created = datetime.now().timestamp()
+    pipe = r.pipeline()
+    pipe.hset(_lobby_key(room.room_id), mapping={
+        "room_id": room.room_id,
+        "owner": room.owner.username if room.owner else "",
+        "player_count": len(room.players),
+        "max_players": room.max_players,
+        "room_code": _to_str(room.room_code),
+        "question_count": len(room.questions) if question_count is None else question_count,
+        "category_ids": json.dumps(category_ids),
+        "category_names": json.dumps(category_names, ensure_ascii=False),
+    })
+    pipe.expire(_lobby_key(room.room_id), ROOM_TTL)
+    pipe.zadd(LOBBY_INDEX_KEY, {room.room_id: created})
+    for category_id in category_ids:
+        pipe.zadd(_lobby_category_key(category_id), {room.room_id: created})
+    pipe.execute()
+
+
+def remove_lobby_room(room_id):
+    category_ids = r.hget(_lobby_key(room_id), "category_ids")
+    pipe = r.pipeline()
+    pipe.delete(_lobby_key(room_id))
+    pipe.zrem(LOBBY_INDEX_KEY, room_id)
+    for category_id in json.loads(category_ids) if category_ids else []:
+        pipe.zrem(_lobby_category_key(category_id), room_id)
+    pipe.execute()
+
+
+def refresh_lobby_room(room_id, owner=None, question_count=None):
+    """Обновляет число игроков (и владельца) в сводке, если комната есть в лобби."""
+    if not _REFRESH_LOBBY_PLAYERS_SCRIPT(keys=[_lobby_key(room_id), _players_key(room_id)]):
+        return
+    if owner:
+        r.hset(_lobby_key(room_id), "owner", owner.username)
+    if question_count is not None:
+        r.hset(_lobby_key(room_id), "question_count", question_count)
+
+
+def get_lobby_rooms(offset=0, limit=50, category_ids=None):
+    if category_ids:
+        # Первые offset+limit объединения лежат среди первых offset+limit каждого индекса
+        pipe = r.pipeline()
+        for category_id in category_ids:
+            pipe.zrevrange(_lobby_category_key(category_id), 0, offset + limit - 1, withscores=True)
+        merged = {}
+        for entries in pipe.execute():
+            merged.update(entries)
+        room_ids = sorted(merged, key=merged.get, reverse=True)[offset:offset + limit]
+    else:
+        room_ids = r.zrevrange(LOBBY_INDEX_KEY, offset, offset + limit - 1)
+    pipe = r.pipeline()
+    for room_id in room_ids:
+        pipe.hgetall(_lobby_key(_decode(room_id)))
+    rooms = []
+    for data in pipe.execute() if room_ids else []:
+        data = _decode_hash(data)
+        if not data:
+            continue
+        rooms.append({
+            "room_id": data["room_id"],
+            "owner": data["owner"],
+            "player_count": int(data["player_count"]),
+            "max_players": int(data["max_players"]),
+            "room_code": data["room_code"],
+            "question_count": int(data["question_count"]),
+            "category_names": json.loads(data["category_names"]),
+        })
+    return rooms
+
+
+def rebuild_lobby_index(category_names_by_id):
+    """Добавляет в лобби ожидающие комнаты, созданные до появления индекса."""
+    added = 0
+    for room_id in get_active_rooms():
+        if r.exists(_lobby_key(room_id)) or get_room_status(room_id) != RoomStatus.WAITING:
+            continue
+        room = get_room(room_id)
+        category_ids = set(question.category_id for question in room.questions)
+        add_lobby_room(room, [name for cat_id, name in category_names_by_id.items() if cat_id in category_ids])
+        added += 1
+    return added
+
+
+# Пул заранее сгенерированных GPT-вопросов:
+#   gpt_pool:{тема}    list — вопросы в JSON
+#   gpt_pool_topics    set  — темы, которые держит наполненными фоновый воркер
+GPT_POOL_TOPICS_KEY = "gpt_pool_topics"
+
+
+def _gpt_pool_key(topic):
+    return f"gpt_pool:{topic}"
+
+
+def add_gpt_pool_topics(topics):
+    if topics:
+        r.sadd(GPT_POOL_TOPICS_KEY, *topics)
+
+
+def get_gpt_pool_topics():
+    return [_decode(topic) for topic in r.smembers(GPT_POOL_TOPICS_KEY)]
+
+
+def get_gpt_pool_size(topic):
+    return r.llen(_gpt_pool_key(topic))
+
+
+def push_gpt_pool_questions(topic, questions):
+    if questions:
+        r.rpush(_gpt_pool_key(topic), *[_question_to_json(q) for q in questions])
+
+
+def pop_gpt_pool_questions(topic_counts):
+    """Забирает из пула вопросы: topic_counts — словарь тема -> сколько нужно."""
+    topics = [topic for topic, count in topic_counts.items() if count > 0]
+    if not topics:
+        return {}
+    pipe = r.pipeline()
+    for topic in topics:
+        pipe.lpop(_gpt_pool_key(topic), topic_counts[topic])
+    return {topic: [_question_from_json(q) for q in data or []]
+            for topic, data in zip(topics, pipe.execute())}
+
+
+# Блокировка пополнения темы хранит метку владельца: продлить и снять её
+# может только тот воркер, который её взял
+_RENEW_GPT_POOL_REFILL_SCRIPT = r.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+""")
+
+_RELEASE_GPT_POOL_REFILL_SCRIPT = r.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+""")
+
+
+def try_acquire_gpt_pool_refill(topic, ttl):
+    """Метка владельца блокировки или None, если тему уже пополняет другой воркер."""
+    token = uuid.uuid4().hex
+    return token if r.set(f"gpt_pool_refill:{topic}", token, nx=True, ex=ttl) else None
+
+
+def renew_gpt_pool_refill(topic, token, ttl):
+    return bool(_RENEW_GPT_POOL_REFILL_SCRIPT(keys=[f"gpt_pool_refill:{topic}"], args=[token, ttl]))
+
+
+def release_gpt_pool_refill(topic, token):
+    _RELEASE_GPT_POOL_REFILL_SCRIPT(keys=[f"gpt_pool_refill:{topic}"], args=[token])
+
+
+# Кэш имён пользователей, общий для воркеров: user:{id}:name -> username
+USER_CACHE_TTL = int(os.getenv('USER_CACHE_REDIS_TTL', str(24 * 60 * 60)))
+
+
+def get_cached_username(user_id):
+    username = r.get(f"user:{user_id}:name")
+    return _decode(username) if username is not None else None
+
+
+def cache_username(user_id, username):
+    r.set(f"user:{user_id}:name", username.encode('utf-8'), ex=USER_CACHE_TTL)
+
+
+# Категории меняются редко: список хранится в Redis для всех воркеров,
+# а версия говорит воркерам, что их локальная копия устарела
+CATEGORIES_KEY = "categories"
+CATEGORIES_VERSION_KEY = "categories_version"
+CATEGORIES_TTL = int(os.getenv('CATEGORIES_TTL', str(60 * 60)))
+
+
+def get_categories_version():
+    return int(r.get(CATEGORIES_VERSION_KEY) or 0)
+
+
+def get_cached_categories():
+    """(версия, список категорий или None) одним запросом."""
+    pipe = r.pipeline()
+    pipe.get(CATEGORIES_VERSION_KEY)
+    pipe.get(CATEGORIES_KEY)
+    version, data = pipe.execute()
+    return int(version or 0), json.loads(data) if data else None
+
+
+# Список пишется, только если версия не сменилась с момента чтения: иначе воркер,
+# прочитавший MySQL до изменения категорий, вернул бы в кэш устаревший список
+_CACHE_CATEGORIES_SCRIPT = r.register_script("""
+if (redis.call('GET', KEYS[2]) or '0') == ARGV[1] then
+    redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+    return 1
+end
+return 0
+""")
+
+
+def cache_categories(categories, version):
+    return bool(_CACHE_CATEGORIES_SCRIPT(keys=[CATEGORIES_KEY, CATEGORIES_VERSION_KEY],
+                                         args=[version, json.dumps(categories, ensure_ascii=False),
+                                               CATEGORIES_TTL]))
+
+
+def bump_categories_version():
+    pipe = r.pipeline()
+    pipe.delete(CATEGORIES_KEY)
+    pipe.incr(CATEGORIES_VERSION_KEY)
+    return pipe.execute()[1]
+
+
+# Версия банка вопросов: увеличивается при изменении вопросов в MySQL,
+# по ней воркеры понимают, что их локальный кэш вопросов устарел
+QUESTIONS_VERSION_KEY = "questions_version"
+
+
+def get_questions_version():
+    return int(r.get(QUESTIONS_VERSION_KEY) or 0)
+
+
+def bump_questions_version():
+    return r.incr(QUESTIONS_VERSION_KEY)
+
+
+# Индекс id вопросов по категориям, общий для всех воркеров:
+#   questions:category:{cat}   set  — id вопросов категории
+#   questions:index            hash — категория -> подпись загруженного набора (число:контрольная сумма)
+QUESTION_INDEX_KEY = "questions:index"
+QUESTION_INDEX_CHUNK = 10000
+
+
+def _question_ids_key(category_id):
+    return f"questions:category:{category_id}"
+
+
+def get_question_index_signatures():
+    return _decode_hash(r.hgetall(QUESTION_INDEX_KEY))
+
+
+def replace_question_ids(category_id, question_ids, signature):
+    """Атомарно заменяет набор id категории; возвращает id, которых в нём больше нет."""
+    key = _question_ids_key(category_id)
+    loading = f"{key}:loading:{uuid.uuid4().hex}"
+    pipe = r.pipeline()
+    for i in range(0, len(question_ids), QUESTION_INDEX_CHUNK):
+        pipe.sadd(loading, *question_ids[i:i + QUESTION_INDEX_CHUNK])
+    pipe.execute()
+    pipe = r.pipeline()
+    if question_ids:
+        pipe.sdiff(key, loading)
+        pipe.rename(loading, key)
+        pipe.hset(QUESTION_INDEX_KEY, category_id, signature)
+    else:
+        pipe.smembers(key)
+        pipe.delete(key)
+        pipe.hdel(QUESTION_INDEX_KEY, category_id)
+    return [_decode(question_id) for question_id in pipe.execute()[0]]
+
+
+def remove_question_categories(category_ids):
+    """Убирает из индекса категории без вопросов; возвращает их бывшие id."""
+    pipe = r.pipeline()
+    for category_id in category_ids:
+        pipe.smembers(_question_ids_key(category_id))
+    pipe.delete(*[_question_ids_key(category_id) for category_id in category_ids])
+    pipe.hdel(QUESTION_INDEX_KEY, *category_ids)
+    removed = pipe.execute()[:len(category_ids)]
+    return [_decode(question_id) for ids in removed for question_id in ids]
+
+
+# Какую версию банка вопросов и когда (unix time) индекс последний раз сверял с MySQL
+QUESTION_INDEX_CHECKED_KEY = "questions:index:checked"
+
+
+def get_question_index_checked():
+    checked = _decode_hash(r.hgetall(QUESTION_INDEX_CHECKED_KEY))
+    if not checked:
+        return None, None
+    return int(checked["version"]), float(checked["at"])
+
+
+def set_question_index_checked(version, checked_at):
+    r.hset(QUESTION_INDEX_CHECKED_KEY, mapping={"version": version, "at": checked_at})
+
+
+def try_acquire_question_index_refresh(interval):
+    """Сверку индекса вопросов с MySQL за один интервал выполняет только один воркер."""
+    return bool(r.set("questions:index:refresh", 1, nx=True, ex=max(int(interval), 1)))
+
+
+def get_question_index_sizes(category_ids):
+    pipe = r.pipeline()
+    for category_id in category_ids:
+        pipe.scard(_question_ids_key(category_id))
+    return pipe.execute() if category_ids else []
+
+
+def random_question_ids(counts):
+    """counts — категория -> сколько разных случайных id из неё взять (SRANDMEMBER)."""
+    pipe = r.pipeline()
+    for category_id, count in counts.items():
+        pipe.srandmember(_question_ids_key(category_id), count)
+    return [_decode(question_id) for ids in (pipe.execute() if counts else []) for question_id in ids]
+
+
+# Недавно виденные вопросы игрока — фильтр Блума в битовой строке Redis:
+#   seen:{user}:cur    текущее поколение, SEEN_FILTER_BITS бит
+#   seen:{user}:prev   предыдущее поколение
+#   seen:{user}:count  сколько вопросов добавлено в текущее поколение
+# Когда текущее поколение набирает SEEN_FILTER_CAPACITY вопросов, оно становится
+# предыдущим, а старое забывается: на игрока не больше 2 * SEEN_FILTER_BITS бит.
+SEEN_FILTER_BITS = int(os.getenv('SEEN_FILTER_BITS', str(16 * 1024)))
+SEEN_FILTER_HASHES = int(os.getenv('SEEN_FILTER_HASHES', '4'))
+SEEN_FILTER_CAPACITY = int(os.getenv('SEEN_FILTER_CAPACITY', '1500'))
+SEEN_FILTER_TTL = int(os.getenv('SEEN_FILTER_TTL', str(30 * 24 * 60 * 60)))
+
+
+def _seen_keys(user_id):
+    return f"seen:{user_id}:cur", f"seen:{user_id}:prev", f"seen:{user_id}:count"
+
+
+def _seen_offsets(question_id):
+    """Номера бит вопроса в фильтре (двойное хеширование)."""
+    digest = hashlib.blake2b(str(question_id).encode('utf-8'), digest_size=16).digest()
+    h1 = int.from_bytes(digest[:8], 'little')
+    h2 = int.from_bytes(digest[8:], 'little') | 1
+    return [(h1 + i * h2) % SEEN_FILTER_BITS for i in range(SEEN_FILTER_HASHES)]
+
+
+_MARK_SEEN_SCRIPT = r.register_script("""
+local cur, prev, count = KEYS[1], KEYS[2], KEYS[3]
+local ttl = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local added = tonumber(ARGV[3])
+for i = 4, #ARGV do
+    redis.call('SETBIT', cur, ARGV[i], 1)
+end
+if redis.call('INCRBY', count, added) >= capacity then
+    redis.call('RENAME', cur, prev)
+    redis.call('DEL', count)
+else
+    redis.call('EXPIRE', cur, ttl)
+    redis.call('EXPIRE', count, ttl)
+end
+redis.call('EXPIRE', prev, ttl)
+return 1
+""")
+
+# KEYS — пары (cur, prev) игроков; ARGV — число хешей и биты всех вопросов подряд.
+# Возвращает для каждого вопроса 1, если его видел хотя бы один игрок.
+_CHECK_SEEN_SCRIPT = r.register_script("""
+local hashes = tonumber(ARGV[1])
+local result = {}
+for q = 0, (#ARGV - 1) / hashes - 1 do
+    local seen = 0
+    for k = 1, #KEYS do
+        local all = 1
+        for i = 1, hashes do
+            if redis.call('GETBIT', KEYS[k], ARGV[1 + q * hashes + i]) == 0 then
+                all = 0
+                break
+            end
+        end
+        if all == 1 then
+            seen = 1
+            break
+        end
+    end
+    result[q + 1] = seen
+end
+return result
+""")
+
+
+def mark_questions_seen(user_ids, question_ids):
+    if not user_ids or not question_ids:
+        return
+    offsets = sorted({offset for question_id in question_ids for offset in _seen_offsets(question_id)})
+    pipe = r.pipeline()
+    for user_id in user_ids:
+        _MARK_SEEN_SCRIPT(keys=_seen_keys(user_id),
+                          args=[SEEN_FILTER_TTL, SEEN_FILTER_CAPACITY, len(question_ids), *offsets],
+                          client=pipe)
+    pipe.execute()
+
+
+def get_seen_questions(user_ids, question_ids):
+    """Какие из вопросов (вероятно) уже видел кто-то из игроков."""
+    if not user_ids or not question_ids:
+        return set()
+    keys = [key for user_id in user_ids for key in _seen_keys(user_id)[:2]]
+    args = [SEEN_FILTER_HASHES] + [offset for question_id in question_ids for offset in _seen_offsets(question_id)]
+    flags = _CHECK_SEEN_SCRIPT(keys=keys, args=args)
+    return {question_id for question_id, seen in zip(question_ids, flags) if seen}
+
+
+# Завершённые игры ждут записи в MySQL в Redis Stream (write-behind):
+# фоновый воркер читает их группой потребителей, пишет пачкой и подтверждает.
+# Неподтверждённые записи упавшего воркера через FINISHED_GAMES_CLAIM_IDLE забирает другой.
+FINISHED_GAMES_STREAM = "finished_games"
+FINISHED_GAMES_GROUP = "persisters"
+FINISHED_GAMES_CLAIM_IDLE = int(os.getenv('FINISHED_GAMES_CLAIM_IDLE', '60'))
+# Игры, которые не удалось записать за отведённое число попыток, и повреждённые записи
+# переезжают в отдельный поток, чтобы не задерживать остальные
+FINISHED_GAMES_DEAD_STREAM = "finished_games:dead"
+FINISHED_GAMES_DEAD_MAXLEN = int(os.getenv('FINISHED_GAMES_DEAD_MAXLEN', '10000'))
+FINISHED_GAMES_ATTEMPTS_KEY = "finished_games:attempts"
+
+
+def _finished_game_to_json(room):
+    return json.dumps({
+        "meta": _room_meta(room),
+        "players": [_player_to_hash(player) for player in room.players.values()],
+        "questions": [_question_to_json(question) for question in room.questions],
+    }, ensure_ascii=False)
+
+
+def _finished_game_from_json(data):
+    data = json.loads(data)
+    meta = {k: str(v) for k, v in data["meta"].items()}
+    players = [_player_from_hash({k: str(v) for k, v in player.items()}) for player in data["players"]]
+    return _room_from_parts(meta, players, [_question_from_json(q) for q in data["questions"]])
+
+
+def enqueue_finished_game(room):
+    return r.xadd(FINISHED_GAMES_STREAM, {"room": _finished_game_to_json(room)})
+
+
+def ensure_finished_games_group():
+    try:
+        r.xgroup_create(FINISHED_GAMES_STREAM, FINISHED_GAMES_GROUP, id="0", mkstream=True)
+    except redis.ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+
+def _parse_finished_games(entries):
+    games = []
+    for entry_id, fields in entries:
+        data = fields.get(b"room") if fields else None
+        try:
+            room = _finished_game_from_json(data)
+        except (TypeError, ValueError, KeyError) as e:
+            print(f"Повреждённая запись завершённой игры {_decode(entry_id)}: {e}")
+            room = None
+        games.append((_decode(entry_id), room))
+    return games
+
+
+def read_finished_games(consumer, count):
+    """Свои неподтверждённые записи (повтор после ошибки), затем новые. Возвращает [(id, Room | None)]."""
+    streams = r.xreadgroup(FINISHED_GAMES_GROUP, consumer, {FINISHED_GAMES_STREAM: "0"}, count=count)
+    entries = streams[0][1] if streams else []
+    if not entries:
+        streams = r.xreadgroup(FINISHED_GAMES_GROUP, consumer, {FINISHED_GAMES_STREAM: ">"}, count=count)
+        entries = streams[0][1] if streams else []
+    return _parse_finished_games(entries)
+
+
+def claim_stale_finished_games(consumer, count):
+    """Забирает записи, которые другой воркер прочитал, но так и не подтвердил."""
+    result = r.xautoclaim(FINISHED_GAMES_STREAM, FINISHED_GAMES_GROUP, consumer,
+                          min_idle_time=FINISHED_GAMES_CLAIM_IDLE * 1000, count=count)
+    return len(result[1]) if result else 0
+
+
+def ack_finished_games(entry_ids):
+    if entry_ids:
+        pipe = r.pipeline()
+        pipe.xack(FINISHED_GAMES_STREAM, FINISHED_GAMES_GROUP, *entry_ids)
+        pipe.xdel(FINISHED_GAMES_STREAM, *entry_ids)
+        pipe.hdel(FINISHED_GAMES_ATTEMPTS_KEY, *entry_ids)
+        pipe.execute()
+
+
+def record_finished_game_failures(entry_ids):
+    """Увеличивает счётчики неудачных попыток записи; возвращает {id записи: попыток}."""
+    pipe = r.pipeline()
+    for entry_id in entry_ids:
+        pipe.hincrby(FINISHED_GAMES_ATTEMPTS_KEY, entry_id, 1)
+    return dict(zip(entry_ids, pipe.execute() if entry_ids else []))
+
+
+def dead_letter_finished_games(entry_ids, reason):
+    """Переносит записи в поток недоставленных игр (с исходными данными) и подтверждает их."""
+    if not entry_ids:
+        return
+    pipe = r.pipeline()
+    for entry_id in entry_ids:
+        pipe.xrange(FINISHED_GAMES_STREAM, entry_id, entry_id)
+    entries = pipe.execute()
+    pipe = r.pipeline()
+    for entry_id, found in zip(entry_ids, entries):
+        fields = dict(found[0][1]) if found else {}
+        fields.update({b"entry_id": entry_id, b"reason": reason})
+        pipe.xadd(FINISHED_GAMES_DEAD_STREAM, fields, maxlen=FINISHED_GAMES_DEAD_MAXLEN, approximate=True)
+    pipe.execute()
+    ack_finished_games(entry_ids)
+
+
+def get_finished_games_backlog():
+    return r.xlen(FINISHED_GAMES_STREAM)
+
+
+# Координация между воркерами: блокировка комнаты на время смены вопроса
+ROOM_LOCK_TIMEOUT = 10
+
+
+def room_lock(room_id, blocking_timeout=ROOM_LOCK_TIMEOUT):
+    return r.lock(f"lock:room:{room_id}", timeout=ROOM_LOCK_TIMEOUT, blocking_timeout=blocking_timeout)
+
+
+# Дедлайны комнат: sorted set, score — время срабатывания в мс (по часам Redis).
+# Что делать по дедлайну, определяется статусом комнаты:
+#   question           — закрыть вопрос и показать правильный ответ
+#   checkCorrectAnswer — перейти к следующему вопросу
+# Срок дедлайна дублируется в meta (deadline_at), чтобы восстановить игру после сбоя.
+_SCHEDULE_DEADLINE_SCRIPT = r.register_script("""
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local deadline = now + tonumber(ARGV[2])
+redis.call('HSET', KEYS[2], 'deadline_at', deadline)
+return redis.call('ZADD', KEYS[1], deadline, ARGV[1])
+""")
+
+# Забирает наступившие дедлайны. Забранный дедлайн переезжает в processing
+# со сроком видимости: если воркер упадёт, не подтвердив обработку,
+# дедлайн вернётся в очередь (см. requeue_stale_deadlines).
+# Срок видимости служит меткой захвата: первым элементом возвращается он, затем room_id
+_CLAIM_DEADLINES_SCRIPT = r.register_script("""
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local token = now + tonumber(ARGV[2])
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', now, 'LIMIT', 0, tonumber(ARGV[1]))
+for _, room_id in ipairs(due) do
+    redis.call('ZREM', KEYS[1], room_id)
+    redis.call('ZADD', KEYS[2], token, room_id)
+end
+table.insert(due, 1, token)
+return due
+""")
+
+# Подтверждает обработку, только если в processing всё ещё тот же захват:
+# более новый захват той же комнаты другим воркером не трогаем
+_ACK_DEADLINE_SCRIPT = r.register_script("""
+if tonumber(redis.call('ZSCORE', KEYS[1], ARGV[1]) or '') == tonumber(ARGV[2]) then
+    return redis.call('ZREM', KEYS[1], ARGV[1])
+end
+return 0
+""")
+
+_REQUEUE_STALE_SCRIPT = r.register_script("""
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local stale = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', now)
+for _, room_id in ipairs(stale) do
+    redis.call('ZREM', KEYS[2], room_id)
+    redis.call('ZADD', KEYS[1], 'NX', now, room_id)
+end
+return #stale
+""")
+
+# Комнаты в статусе question / checkCorrectAnswer без дедлайна — осиротевшие
+# (например, старые таймеры в памяти погибшего воркера). Ставим им дедлайн
+# из deadline_at, а если его нет — на текущий момент.
+# KEYS: дедлайны, processing, затем meta каждой комнаты из ARGV в том же порядке.
+_ADOPT_ORPHANS_SCRIPT = r.register_script("""
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local adopted = 0
+for i, room_id in ipairs(ARGV) do
+    local meta = KEYS[i + 2]
+    local status = redis.call('HGET', meta, 'status')
+    if (status == 'question' or status == 'checkCorrectAnswer')
+            and not redis.call('ZSCORE', KEYS[1], room_id)
+            and not redis.call('ZSCORE', KEYS[2], room_id) then
+        local deadline = tonumber(redis.call('HGET', meta, 'deadline_at') or '') or now
+        redis.call('ZADD', KEYS[1], deadline, room_id)
+        adopted = adopted + 1
+    end
+end
+return adopted
+""")
+
+DEADLINES_PROCESSING_KEY = "room_deadlines:processing"
+DEADLINE_VISIBILITY_TIMEOUT = int(os.getenv('DEADLINE_VISIBILITY_TIMEOUT', '30'))
+
+
+def schedule_deadline(room_id, delay_seconds):
+    _SCHEDULE_DEADLINE_SCRIPT(keys=[DEADLINES_KEY, _meta_key(room_id)],
+                              args=[room_id, int(delay_seconds * 1000)])
+
+
+def cancel_deadline(room_id):
+    pipe = r.pipeline()
+    pipe.zrem(DEADLINES_KEY, room_id)
+    pipe.zrem(DEADLINES_PROCESSING_KEY, room_id)
+    pipe.execute()
+
+
+def claim_due_deadlines(limit):
+    """Список (room_id, метка захвата); метку нужно передать в ack_deadline."""
+    token, *due = _CLAIM_DEADLINES_SCRIPT(keys=[DEADLINES_KEY, DEADLINES_PROCESSING_KEY],
+                                          args=[limit, DEADLINE_VISIBILITY_TIMEOUT * 1000])
+    return [(_decode(room_id), token) for room_id in due]
+
+
+def ack_deadline(room_id, token):
+    _ACK_DEADLINE_SCRIPT(keys=[DEADLINES_PROCESSING_KEY], args=[room_id, token])
+
+
+def requeue_stale_deadlines():
+    return _REQUEUE_STALE_SCRIPT(keys=[DEADLINES_KEY, DEADLINES_PROCESSING_KEY])
+
+
+def adopt_orphaned_rooms(batch_size=500):
+    room_ids = get_active_rooms()
+    adopted = 0
+    for i in range(0, len(room_ids), batch_size):
+        batch = room_ids[i:i + batch_size]
+        adopted += _ADOPT_ORPHANS_SCRIPT(keys=[DEADLINES_KEY, DEADLINES_PROCESSING_KEY,
+                                               *[_meta_key(room_id) for room_id in batch]],
+                                         args=batch)
+    return adopted
+
+
+# Фоновая генерация вопросов комнаты держит аренду: room_id -> срок в мс (по часам Redis).
+# Генератор продлевает её с каждым вопросом; срок служит и меткой владельца, как у дедлайнов.
+# Если воркер упал посреди генерации, аренда истекает и комнату добирает recovery_loop.
+GENERATIONS_KEY = "room_generations"
+
+_START_GENERATION_SCRIPT = r.register_script("""
+local t = redis.call('TIME')
+local token = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000) + tonumber(ARGV[2])
+redis.call('ZADD', KEYS[1], token, ARGV[1])
+redis.call('HSET', KEYS[2], 'expected_questions', ARGV[3], 'generation_fallback', ARGV[4])
+return token
+""")
+
+_RENEW_GENERATION_SCRIPT = r.register_script("""
+if tonumber(redis.call('ZSCORE', KEYS[1], ARGV[1]) or '') ~= tonumber(ARGV[2]) then
+    return 0
+end
+local t = redis.call('TIME')
+local token = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000) + tonumber(ARGV[3])
+redis.call('ZADD', KEYS[1], token, ARGV[1])
+return token
+""")
+
+_FINISH_GENERATION_SCRIPT = r.register_script("""
+if tonumber(redis.call('ZSCORE', KEYS[1], ARGV[1]) or '') == tonumber(ARGV[2]) then
+    return redis.call('ZREM', KEYS[1], ARGV[1])
+end
+return 0
+""")
+
+# Забирает истёкшие аренды, продлевая их новой меткой: первым элементом возвращается она, затем room_id
+_CLAIM_GENERATIONS_SCRIPT = r.register_script("""
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local token = now + tonumber(ARGV[2])
+local expired = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', now, 'LIMIT', 0, tonumber(ARGV[1]))
+for _, room_id in ipairs(expired) do
+    redis.call('ZADD', KEYS[1], token, room_id)
+end
+table.insert(expired, 1, token)
+return expired
+""")
+
+
+def start_generation(room_id, lease_seconds, expected_questions, fallback_category_ids):
+    """Берёт аренду генерации; возвращает метку для renew_generation и finish_generation."""
+    return _START_GENERATION_SCRIPT(keys=[GENERATIONS_KEY, _meta_key(room_id)],
+                                    args=[room_id, int(lease_seconds * 1000), expected_questions,
+                                          json.dumps(fallback_category_ids)])
+
+
+def renew_generation(room_id, token, lease_seconds):
+    """Новая метка или 0, если аренда уже не наша (истекла и её забрал другой воркер)."""
+    return _RENEW_GENERATION_SCRIPT(keys=[GENERATIONS_KEY], args=[room_id, token, int(lease_seconds * 1000)])
+
+
+def finish_generation(room_id, token):
+    return bool(_FINISH_GENERATION_SCRIPT(keys=[GENERATIONS_KEY], args=[room_id, token]))
+
+
+def claim_expired_generations(limit, lease_seconds):
+    """(метка, список room_id) — комнаты, чья генерация потеряла владельца."""
+    token, *room_ids = _CLAIM_GENERATIONS_SCRIPT(keys=[GENERATIONS_KEY], args=[limit, int(lease_seconds * 1000)])
+    return token, [_decode(room_id) for room_id in room_ids]
+
+
+def is_generating(room_id):
+    """Вопросы ещё генерируются: аренда есть и не истекла."""
+    until = r.zscore(GENERATIONS_KEY, room_id)
+    return until is not None and until > datetime.now().timestamp() * 1000
+
+
+def get_generation_fallback(room_id):
+    fallback = r.hget(_meta_key(room_id), "generation_fallback")
+    return json.loads(fallback) if fallback else []
+
+
+# Продлевает TTL всех ключей комнаты одним вызовом; ключи передаются в KEYS
+_TOUCH_ROOM_SCRIPT = r.register_script("""
+for _, key in ipairs(KEYS) do
+    redis.call('EXPIRE', key, ARGV[1])
+end
+return 1
+""")
+
+
+def _room_keys(room_id, code):
+    keys = [_meta_key(room_id), _players_key(room_id), _questions_key(room_id), _scores_key(room_id),
+            _sids_key(room_id), f"quest_pos:{room_id}", _lobby_key(room_id)]
+    if code:
+        keys.append(f"code:{_decode(code)}")
+    return keys
+
+
+def touch_room(room_id, ttl=ROOM_TTL):
+    """TTL комнаты, её игроков, кода и sid подключенных к ней клиентов — при смене фазы игры."""
+    pipe = r.pipeline()
+    pipe.lrange(_players_key(room_id), 0, -1)
+    pipe.hget(_meta_key(room_id), "room_code")
+    pipe.smembers(_sids_key(room_id))
+    user_ids, code, sids = pipe.execute()
+    keys = _room_keys(room_id, code)
+    keys += [_player_key(room_id, _decode(user_id)) for user_id in user_ids]
+    for sid in sids:
+        keys.extend(_sid_keys(_decode(sid)))
+    _TOUCH_ROOM_SCRIPT(keys=keys, args=[ttl])
+
+
+def touch_player(room_id, user_id, ttl=ROOM_TTL):
+    """TTL ключей комнаты и одного игрока — при входе, без обхода всех игроков комнаты.
+
+    Ключи sid получают TTL в save_request_sid."""
+    keys = _room_keys(room_id, r.hget(_meta_key(room_id), "room_code"))
+    keys.append(_player_key(room_id, user_id))
+    _TOUCH_ROOM_SCRIPT(keys=keys, args=[ttl])
+
+
+def try_schedule_lobby_broadcast(room_id, window):
+    """Рассылку состава лобби на ближайшее окно планирует только один воркер."""
+    return bool(r.set(f"room:{room_id}:lobby_broadcast", 1, nx=True, px=max(int(window * 1000), 1)))
+
+
+def _prune_zset(key, exists_key):
+    """Удаляет из sorted set room_id, чьи ключи уже истекли."""
+    room_ids = [_decode(room_id) for room_id, _ in r.zscan_iter(key)]
+    if not room_ids:
+        return 0
+    pipe = r.pipeline()
+    for room_id in room_ids:
+        pipe.exists(exists_key(room_id))
+    stale = [room_id for room_id, exists in zip(room_ids, pipe.execute()) if not exists]
+    if stale:
+        r.zrem(key, *stale)
+    return len(stale)
+
+
+def sweep_rooms():
+    """Сверяет индексы (active_rooms, лобби, дедлайны, генерации) с реально существующими комнатами."""
+    room_ids = get_active_rooms()
+    pipe = r.pipeline()
+    for room_id in room_ids:
+        pipe.exists(_meta_key(room_id))
+    stale = [room_id for room_id, exists in zip(room_ids, pipe.execute() if room_ids else []) if not exists]
+    if stale:
+        r.srem("active_rooms", *stale)
+    lobby = _prune_zset(LOBBY_INDEX_KEY, _lobby_key)
+    for key in r.scan_iter(match=f"{LOBBY_INDEX_KEY}:category:*"):
+        lobby += _prune_zset(key, _lobby_key)
+    deadlines = _prune_zset(DEADLINES_KEY, _meta_key) + _prune_zset(DEADLINES_PROCESSING_KEY, _meta_key)
+    generations = _prune_zset(GENERATIONS_KEY, _meta_key)
+    return {"active_rooms": len(stale), "lobby": lobby, "deadlines": deadlines, "generations": generations}
+
+
+def try_acquire_sweeper(interval):
+    """Чистку за один интервал выполняет только один воркер."""
+    return bool(r.set("room_sweeper", 1, nx=True, ex=max(int(interval), 1)))
+
+
+def get_memory_stats():
+    info = r.info("memory")
+    pipe = r.pipeline()
+    pipe.scard("active_rooms")
+    pipe.zcard(LOBBY_INDEX_KEY)
+    pipe.zcard(DEADLINES_KEY)
+    pipe.dbsize()
+    active_rooms, lobby_rooms, deadlines, keys = pipe.execute()
+    return {
+        "used_memory": info.get("used_memory"),
+        "used_memory_human": info.get("used_memory_human"),
+        "used_memory_peak_human": info.get("used_memory_peak_human"),
+        "keys": keys,
+        "active_rooms": active_rooms,
+        "lobby_rooms": lobby_rooms,
+        "deadlines": deadlines,
+    }
+
+
 def clear_room_data(room_id):
+    code = r.hget(_meta_key(room_id), "room_code")
+    if code:
+        release_room_code(_decode(code), room_id)
     delete_room(room_id)
     delete_quest_position(room_id)
+    cancel_deadline(room_id)
+    remove_lobby_room(room_id)
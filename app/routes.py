@@ -1,23 +1,61 @@
+import base64
+import os
 import secrets
 import string
 import uuid
 
 from flask import Blueprint, jsonify, request, make_response
 from flask_jwt_extended import jwt_required, create_access_token, set_access_cookies, unset_jwt_cookies, \
-    get_jwt_identity
+    get_jwt_identity, get_jwt
 from .models import Room, Player, RoomStatus
 
 from . import db
 from . import redis_storage
+from .sockets import socketio, generate_room_questions, GENERATION_LEASE
 
 bp = Blueprint('main', __name__)
 
+# Сколько секунд клиент может не перезапрашивать список категорий
+CATEGORIES_MAX_AGE = int(os.getenv('CATEGORIES_MAX_AGE', '300'))
+# Лимит игроков в комнате для большой аудитории (large_audience при создании)
+LARGE_ROOM_MAX_PLAYERS = int(os.getenv('LARGE_ROOM_MAX_PLAYERS', '5000'))
+
 
 def generate_code(length: int = 6) -> str:
     alphabet = string.ascii_uppercase + string.digits
     return ''.join(secrets.choice(alphabet) for _ in range(length))
 
 
+# 36^6 ≈ 2 млрд кодов: даже при миллионах активных комнат коллизия — редкость,
+# а занятый код просто генерируется заново
+ROOM_CODE_ATTEMPTS = 10
+
+
+def allocate_room_code(room_id):
+    # Выданные коды и коллизии считает claim_room_code в Redis
+    for _ in range(ROOM_CODE_ATTEMPTS):
+        code = generate_code()
+        if redis_storage.claim_room_code(code, room_id):
+            return code
+    redis_storage.record_room_code_failure()
+    return None
+
+
+def get_current_user(user_id):
+    # Имя пользователя записано в токен при входе; для старых токенов — кэш get_user
+    username = get_jwt().get('username')
+    if username:
+        return {'success': True, 'login': username}
+    return db.get_user(user_id)
+
+
+def server_busy():
+    # Очередь на проверку паролей переполнена — клиент повторит запрос позже
+    resp = make_response(jsonify({'message': 'Server is busy, try again later'}), 503)
+    resp.headers['Retry-After'] = '1'
+    return resp
+
+
 @bp.route('/api/user/signup', methods=['POST'])
 def signup():
     data = request.json
@@ -29,6 +67,9 @@ def signup():
 
     result = db.sign_up(login, password)
 
+    if result.get('busy'):
+        return server_busy()
+
     if not result['success']:
         return jsonify({'message': 'User already exists'}), 400
 
@@ -46,10 +87,13 @@ def signin():
 
     result = db.sign_in(login, password)
 
+    if result.get('busy'):
+        return server_busy()
+
     if not result['success']:
         return jsonify({'message': 'Invalid login or password'}), 401
 
-    access_token = create_access_token(identity=result['user_id'])
+    access_token = create_access_token(identity=result['user_id'], additional_claims={'username': result['login']})
     resp = make_response(jsonify({'status': 'OK'}), 200)
     set_access_cookies(resp, access_token)
 
@@ -70,7 +114,7 @@ def logout():
 def me():
     user_id = get_jwt_identity()
 
-    user = db.get_user(user_id)
+    user = get_current_user(user_id)
 
     if not user['success']:
         return jsonify({'message': 'User not found'}), 404
@@ -84,10 +128,11 @@ def create_room():
     data = request.json
     count_questions = data.get('count_questions')
     category_ids = data.get('category_ids')
+    large = bool(data.get('large_audience'))
 
     user_id = get_jwt_identity()
 
-    user = db.get_user(user_id)
+    user = get_current_user(user_id)
     if not user['success']:
         return jsonify({'message': 'User not found'}), 404
 
@@ -96,6 +141,9 @@ def create_room():
     # Генерация уникального ID комнаты
     room_id = str(uuid.uuid4())
     new_room = Room(room_id=room_id)
+    if large:
+        new_room.large = True
+        new_room.max_players = LARGE_ROOM_MAX_PLAYERS
 
     # Добавляем создателя
     player = Player(user_id=user_id, username=username)
@@ -103,25 +151,41 @@ def create_room():
     new_room.owner = player
 
     # Загружаем вопросы
-    questions = db.get_questions(count_questions=count_questions, category_ids=category_ids)
+    questions = db.get_questions(count_questions=count_questions, category_ids=category_ids, user_ids=[user_id])
     if not questions['success']:
         return jsonify({'message': 'No questions available'}), 500
 
-    new_room.questions = questions['questions']
+    # Пустая категория или промах MySQL — комната создаётся без вопросов, как и раньше
+    new_room.questions = questions['questions'] or []
     new_room.current_question_index = 0
+    # Сколько GPT-вопросов ещё догенерируется в фоне
+    pending = questions.get('pending', 0)
 
-    # Генерируем код и сохраняем его в комнате
-    code = generate_code()
+    # Занимаем свободный код (код -> room_id) и сохраняем его в комнате
+    code = allocate_room_code(room_id)
+    if code is None:
+        return jsonify({'message': 'Could not allocate room code'}), 503
     new_room.room_code = code
 
-    # Сохраняем комнату в Redis
+    # Сохраняем комнату в Redis и сразу задаём TTL: если дальше что-то упадёт,
+    # ключи истекут, а очистка уберёт комнату из индексов
     redis_storage.save_room(room_id, new_room)
+    redis_storage.touch_room(room_id)
 
-    # Сохраняем сопоставление код -> room_id
-    redis_storage.save_room_code(code, room_id)
-
-    # Добавляем комнату в список активных
+    # Добавляем комнату в список активных и в индекс лобби
     redis_storage.add_active_room(room_id)
+    categories = db.get_categories()['categories'] or []
+    room_category_ids = set(question.category_id for question in new_room.questions)
+    if pending:
+        room_category_ids.add(os.getenv('GPT_CATEGORY_ID'))
+    redis_storage.add_lobby_room(new_room, [cat['name'] for cat in categories if cat['id'] in room_category_ids],
+                                 category_ids=room_category_ids, question_count=len(new_room.questions) + pending)
+
+    if pending:
+        token = redis_storage.start_generation(room_id, GENERATION_LEASE, len(new_room.questions) + pending,
+                                               questions['fallback_category_ids'])
+        socketio.start_background_task(generate_room_questions, room_id, pending, questions['topics'],
+                                       questions['fallback_category_ids'], token)
 
     return jsonify({'room_code': code, 'room_id': room_id}), 201
 
@@ -142,33 +206,32 @@ def join_room_by_code():
 
     user_id = get_jwt_identity()
 
-    user = db.get_user(user_id)
+    user = get_current_user(user_id)
     if not user['success']:
         return jsonify({'message': 'User not found'}), 404
 
     username = user['login']
 
-    # Получаем комнату из Redis
-    room = redis_storage.get_room(room_id)
-    if not room:
+    # Получаем метаданные комнаты из Redis
+    meta = redis_storage.get_room_meta(room_id)
+    if not meta:
         return jsonify({'message': 'Room not found'}), 404
 
     # Проверки
-    if user_id in room.players:
+    if redis_storage.get_player(room_id, user_id):
         return jsonify({'message': 'Player already in room'}), 409
 
-    if room.status != RoomStatus.WAITING:
+    if RoomStatus(meta['status']) != RoomStatus.WAITING:
         return jsonify({'message': 'Quiz has already started'}), 400
 
-    if len(room.players) >= room.max_players:
+    if redis_storage.get_players_count(room_id) >= int(meta['max_players']):
         return jsonify({'message': 'Room is full'}), 400
 
-    # Добавляем игрока в память
+    # Добавляем игрока в Redis
     player = Player(user_id=user_id, username=username)
-    room.players[user_id] = player
-
-    # Сохраняем обновлённую комнату в Redis
-    redis_storage.save_room(room_id, room)
+    redis_storage.add_player(room_id, player)
+    redis_storage.refresh_lobby_room(room_id)
+    redis_storage.touch_player(room_id, user_id)
 
     return jsonify({'room_id': room_id}), 200
 
@@ -179,41 +242,58 @@ def get_categories_list():
     categories = db.get_categories()
     if not categories['success']:
         return jsonify({'message': 'No categories available'}), 500
-    return jsonify({'categories': categories['categories']})
+    resp = make_response(jsonify({'categories': categories['categories']}))
+    # Категории меняются редко: клиент переиспользует ответ, а при повторе получает 304 без тела
+    resp.set_etag(categories['etag'])
+    resp.cache_control.private = True
+    resp.cache_control.max_age = CATEGORIES_MAX_AGE
+    return resp.make_conditional(request)
 
 
 @bp.route('/api/rooms/list', methods=['GET'])
 @jwt_required()
 def list_rooms():
-    categories = db.get_categories()['categories']
-    available_rooms = []
-    # Получаем список активных комнат
-    active_room_ids = redis_storage.get_active_rooms()
-    for room_id in active_room_ids:
-        room = redis_storage.get_room(room_id)
-        if room and room.status == RoomStatus.WAITING:
-            s = set(question.category_id for question in room.questions)
-            available_rooms.append({
-                'room_id': room.room_id,
-                'owner': room.owner.username,
-                'player_count': len(room.players),
-                'max_players': room.max_players,
-                'room_code': room.room_code,
-                'question_count': len(room.questions),
-                'category_names': [cat['name'] for cat in categories if cat['id'] in s]
-            })
-
-    return jsonify({'rooms': available_rooms}), 200
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    limit = min(max(request.args.get('limit', 50, type=int), 1), 200)
+    category_ids = request.args.getlist('category_id')
+    # Сводки комнат в ожидании читаются из индекса лобби одним запросом
+    available_rooms = redis_storage.get_lobby_rooms(offset=offset, limit=limit, category_ids=category_ids)
+    next_offset = offset + limit if len(available_rooms) == limit else None
+
+    return jsonify({'rooms': available_rooms, 'next_offset': next_offset}), 200
 
 
 @bp.route('/api/user/past_games', methods=['GET'])
 @jwt_required()
 def get_past_games():
     user_id = get_jwt_identity()
-    past_games = db.get_past_games(user_id)
+    limit = min(max(request.args.get('limit', db.PAST_GAMES_PAGE_SIZE, type=int), 1), 100)
+    # Курсор — время и room_id последней игры предыдущей страницы
+    cursor = request.args.get('cursor')
+    before = None
+    if cursor:
+        try:
+            before = tuple(base64.urlsafe_b64decode(cursor.encode()).decode('utf-8').split('|', 1))
+        except (ValueError, UnicodeDecodeError):
+            before = None
+        if before is None or len(before) != 2:
+            return jsonify({'message': 'Invalid cursor'}), 400
+    past_games = db.get_past_games(user_id, limit=limit, before=before)
     if not past_games['success']:
         return jsonify({'message': 'No games available'}), 500
-    return jsonify({'games': past_games['games']}), 200
+    next_before = past_games['next_before']
+    next_cursor = base64.urlsafe_b64encode('|'.join(next_before).encode('utf-8')).decode() if next_before else None
+    return jsonify({'games': past_games['games'], 'next_cursor': next_cursor}), 200
+
+
+@bp.route('/api/user/stats', methods=['GET'])
+@jwt_required()
+def get_user_stats():
+    user_id = get_jwt_identity()
+    stats = db.get_user_stats(user_id)
+    if not stats['success']:
+        return jsonify({'message': 'No stats available'}), 500
+    return jsonify(stats['stats']), 200
 
 
 @bp.route('/api/rooms/<room_code>/room_id', methods=['GET'])
@@ -223,9 +303,8 @@ def get_room_id_by_room_code(room_code):
     room_id = redis_storage.get_room_id_by_code(room_code)
     if not room_id:
         return jsonify({'message': 'Room not found'}), 404
-    room = redis_storage.get_room(room_id)
-    if not room:
+    if not redis_storage.room_exists(room_id):
         return jsonify({'message': 'Room not found'}), 404
-    if user_id not in room.players:
+    if not redis_storage.get_player(room_id, user_id):
         return jsonify({'message': 'User not in room'}), 403
     return jsonify({'room_id': room_id}), 200
@@ -1,20 +1,43 @@
+import os
+import socket
 from datetime import datetime
-from threading import Lock
-from time import time
-from typing import Dict
 
 from flask_socketio import SocketIO, join_room, leave_room
 from flask import request
 
-from . import redis_storage, db
+from . import redis_storage, db, question_pool
+from .gpt import GPT_TIMEOUT, stream_shared_gpt_questions
 from .models import RoomStatus, Question
 
 socketio = SocketIO()
 
-# key = room_id, value = position of quest
-room_locks: Dict[str, Lock] = {}
-question_start_times: Dict[str, float] = {}
-global_init_lock = Lock()
+# Планировщик дедлайнов: один на воркер, опрашивает общий sorted set в Redis
+SCHEDULER_TICK = float(os.getenv('SCHEDULER_TICK', '0.1'))
+SCHEDULER_BATCH = int(os.getenv('SCHEDULER_BATCH', '100'))
+RECOVERY_INTERVAL = float(os.getenv('RECOVERY_INTERVAL', '10'))
+SWEEP_INTERVAL = float(os.getenv('SWEEP_INTERVAL', '60'))
+# Как часто проверять, не устарел ли индекс вопросов в Redis
+QUESTION_INDEX_CHECK_INTERVAL = float(os.getenv('QUESTION_INDEX_CHECK_INTERVAL', '5'))
+# Запись завершённых игр в MySQL: пачки до PERSIST_BATCH игр раз в PERSIST_INTERVAL секунд,
+# при ошибке базы — повтор с растущей паузой до PERSIST_MAX_BACKOFF
+PERSIST_INTERVAL = float(os.getenv('PERSIST_INTERVAL', '1'))
+PERSIST_BATCH = int(os.getenv('PERSIST_BATCH', '100'))
+PERSIST_MAX_BACKOFF = float(os.getenv('PERSIST_MAX_BACKOFF', '30'))
+# Игра, которую не удалось записать столько раз при доступной базе, уходит в finished_games:dead
+PERSIST_MAX_ATTEMPTS = int(os.getenv('PERSIST_MAX_ATTEMPTS', '5'))
+SHOW_ANSWER_TIME = 5
+# Сколько вопросов должно быть готово, чтобы начать игру, пока остальные генерируются
+GPT_START_QUESTIONS = int(os.getenv('GPT_START_QUESTIONS', '3'))
+# Аренда фоновой генерации: продлевается с каждым вопросом и должна пережить паузу LLM;
+# истёкшую аренду (воркер упал) подхватывает recovery_loop и добирает вопросы из базы
+GENERATION_LEASE = int(os.getenv('GENERATION_LEASE', str(int(GPT_TIMEOUT * 2) + 30)))
+# В больших комнатах рассылаются только первые места таблицы лидеров
+LEADERBOARD_TOP = int(os.getenv('LEADERBOARD_TOP', '10'))
+# В больших комнатах события «игрок ответил» копятся столько секунд и уходят одним сообщением
+ANSWER_BATCH_WINDOW = float(os.getenv('ANSWER_BATCH_WINDOW', '0.15'))
+# В больших комнатах состав лобби рассылается не чаще раза в столько секунд
+LOBBY_BROADCAST_WINDOW = float(os.getenv('LOBBY_BROADCAST_WINDOW', '1'))
+_scheduler_started = False
 
 
 def serialize_player(player):
@@ -43,34 +66,53 @@ def serialize_players(players):
     return [serialize_player(player) for player in players]
 
 
+# Буферы событий больших комнат лежат в Redis (room:{id}:batch:{event}) и общие для воркеров:
+# рассылку через window секунд планирует воркер, добавивший первое событие окна,
+# а close_question забирает остаток перед показом правильного ответа, кто бы его ни накопил
+def batch_added(room_id, event, batch_size, window=ANSWER_BATCH_WINDOW):
+    """Событие уже добавлено в буфер комнаты; batch_size — размер буфера после добавления."""
+    if batch_size == 1:
+        socketio.start_background_task(_flush_later, room_id, event, window)
+
+
+def _flush_later(room_id, event, window):
+    socketio.sleep(window)
+    flush_batch(room_id, event)
+
+
+def flush_batch(room_id, event):
+    items = redis_storage.drain_batch(room_id, event)
+    if items:
+        socketio.emit(f"{event}_batch", items, to=room_id)
+
+
 @socketio.on("join_room")
 def join_game_room(data):
     room_id = data['room_id']
 
     user_id = data['user_id']
-    # Получаем комнату из Redis
-    room = redis_storage.get_room(room_id)
-
-    if room is None:
+    # Проверяем комнату и игрока в Redis
+    if not redis_storage.room_exists(room_id):
         socketio.emit("Error", {"message": "This room doesn't exist"}, to=request.sid)
         return
-    user = room.players.get(user_id)
+    user = redis_storage.get_player(room_id, user_id)
     if user is None:
         socketio.emit("Error", {"message": "This user is not in room"}, to=request.sid)
         return
     print("Room exists")
-    with global_init_lock:
-        room_locks.setdefault(room_id, Lock())
-        # Инициализируем позицию вопроса в Redis
-        if redis_storage.get_quest_position(room_id) is None:
-            redis_storage.set_quest_position(room_id, -1)
-        question_start_times.setdefault(room_id, 0.0)
+    # Инициализируем позицию вопроса в Redis
+    redis_storage.init_quest_position(room_id)
 
     print(f"Received data = {data}")
     join_room(room_id)
     redis_storage.save_request_sid(request.sid, user_id, room_id)
+    redis_storage.touch_player(room_id, user_id)
     socketio.emit("message", {"message": "Join room success"}, to=request.sid)
-    all_players_in_lobby(data)
+    large = redis_storage.is_large_room(room_id)
+    if large:
+        # Вошедший сразу получает состав лобби, остальные — общей рассылкой раз в окно
+        socketio.emit("all_players_in_lobby", lobby_players(room_id), to=request.sid)
+    lobby_changed(room_id, large)
 
 
 @socketio.on("leave_room")
@@ -93,29 +135,28 @@ def leave_game_room(data):
         print(f"Error leaving room: {e}")
         return
 
-    room = redis_storage.get_room(room_id)
+    meta = redis_storage.get_room_meta(room_id)
 
-    if room is None:
+    if meta is None:
         socketio.emit("Error", {"message": "This room doesn't exist"}, to=request.sid)
         return
-    player = room.players.get(user_id)
+    player = redis_storage.get_player(room_id, user_id)
 
     if player is None:
         socketio.emit("Error", {"message": "This player doesn't exist"}, to=request.sid)
         return
-    room.players.pop(user_id, None)
+    redis_storage.remove_player(room_id, user_id)
+    redis_storage.refresh_lobby_room(room_id)
     print("Player was deleted from room")
-    if player.user_id == room.owner.user_id:
-        other_players = [p for p in room.players.values()]
+    if player.user_id == meta["owner"]:
+        other_players = redis_storage.get_players(room_id)
         if len(other_players) == 0:
             redis_storage.clear_room_data(room_id)
-            room_locks.pop(room_id)
-            question_start_times.pop(room_id)
             print("Room was deleted")
         else:
-            room.owner = other_players[0]
-            redis_storage.save_room(room_id, room)
-            all_players_in_lobby({"room_id":room_id})
+            redis_storage.set_room_owner(room_id, other_players[0])
+            redis_storage.refresh_lobby_room(room_id, owner=other_players[0])
+            lobby_changed(room_id)
 
 
 @socketio.on("room_status")
@@ -124,11 +165,11 @@ def status_room(data):
     if room_id is None:
         socketio.emit("Error", {"message": "This room_id doesn't exist"}, to=request.sid)
         return
-    room = redis_storage.get_room(room_id)
+    status = redis_storage.get_room_status(room_id)
     pos = redis_storage.get_quest_position(room_id)
     res = {
-        "status" : room.status,
-        "question" : serialize_question(room.questions[pos], pos+1)
+        "status" : status,
+        "question" : serialize_question(redis_storage.get_question(room_id, pos), pos+1)
     }
     socketio.emit("room_status", res, to=room_id)
 
@@ -136,7 +177,9 @@ def status_room(data):
 @socketio.on("disconnect")
 def disconnect():
 
-    user_id, room_id = redis_storage.get_request_sid_data(request.sid)
+    # Данные sid могли истечь по TTL — тогда отключение ничего не меняет в комнате
+    sid_data = redis_storage.get_request_sid_data(request.sid)
+    user_id, room_id = sid_data if sid_data else (None, None)
 
     if not user_id or not room_id:
         print(f"Missing user_id or room_id for SID: {request.sid}")
@@ -149,17 +192,18 @@ def disconnect():
 
 
 
-    room = redis_storage.get_room(room_id)
+    meta = redis_storage.get_room_meta(room_id)
 
-    if room is None:
+    if meta is None:
         socketio.emit("Error", {"message": "This room doesn't exist"}, to=request.sid)
         return
-    player = room.players.get(user_id)
+    player = redis_storage.get_player(room_id, user_id)
 
     if player is None:
         socketio.emit("Error", {"message": "This player doesn't exist"}, to=request.sid)
         return
-    if room.status == RoomStatus.WAITING or room.status == RoomStatus.FINISHED:
+    status = RoomStatus(meta["status"])
+    if status == RoomStatus.WAITING or status == RoomStatus.FINISHED:
         try:
             leave_room(room_id)
             redis_storage.delete_request_sid(request.sid)
@@ -168,18 +212,17 @@ def disconnect():
             print(f"Error leaving room: {e}")
             return
 
-        room.players.pop(user_id, None)
-        if player.user_id == room.owner.user_id:
-            other_players = [p for p in room.players.values()]
+        redis_storage.remove_player(room_id, user_id)
+        redis_storage.refresh_lobby_room(room_id)
+        if player.user_id == meta["owner"]:
+            other_players = redis_storage.get_players(room_id)
             if len(other_players) == 0:
                 redis_storage.clear_room_data(room_id)
-                room_locks.pop(room_id)
-                question_start_times.pop(room_id)
                 print("Room was deleted")
             else:
-                room.owner = other_players[0]
-                redis_storage.save_room(room_id, room)
-                all_players_in_lobby({"room_id": room_id})
+                redis_storage.set_room_owner(room_id, other_players[0])
+                redis_storage.refresh_lobby_room(room_id, owner=other_players[0])
+                lobby_changed(room_id)
             print("Player was deleted from room")
 
 
@@ -192,38 +235,54 @@ def start_quiz(data):
     if not room_id:
         socketio.emit("Error", {"message": "missing room_id"}, to=request.sid)
         return
-    # Получаем комнату из Redis
-    room = redis_storage.get_room(room_id)
-    if room is None:
+    # Получаем метаданные комнаты из Redis
+    meta = redis_storage.get_room_meta(room_id)
+    if meta is None:
         socketio.emit("Error", {"message": f"Room {room_id} not found"}, to=request.sid)
         return
-    if not getattr(room, "questions", None):
+    questions_count = redis_storage.get_questions_count(room_id)
+    if redis_storage.is_generating(room_id):
+        required = min(GPT_START_QUESTIONS, int(meta["expected_questions"]))
+        if questions_count < required:
+            socketio.emit("Error", {"message": "Questions are still being generated"}, to=request.sid)
+            return
+    if not questions_count:
         socketio.emit("Error", {"message": "No questions in this room"}, to=request.sid)
         return
 
-    if user_id != room.owner.user_id:
+    if user_id != meta["owner"]:
         socketio.emit("Error", "Not owner try to start game", to=room_id)
         return
 
-    # Устанавливаем позицию вопроса в Redis
-    redis_storage.set_quest_position(room_id, 0)
-    for player in room.players.values():
-        player.score = 0
-        player.correct = 0
-        player.answer = ""
-        player.answered = False
-    room.timer_start = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    # Сохраняем об новлённую комнату в Redis
-    redis_storage.save_room(room_id, room)
+    with redis_storage.room_lock(room_id):
+        status = redis_storage.get_room_status(room_id)
+        if status in (RoomStatus.QUESTION, RoomStatus.CHECK_CORRECT_ANSWER):
+            socketio.emit("Error", {"message": "Quiz has already started"}, to=request.sid)
+            return
 
-    firstQuest = room.questions[0]
+        if not redis_storage.is_generating(room_id):
+            # Вопросы выбирались по истории владельца — убираем виденные остальными игроками
+            questions = redis_storage.get_room_questions(room_id)
+            fresh = db.replace_seen_questions(questions, redis_storage.get_player_ids(room_id))
+            for pos, (question, replacement) in enumerate(zip(questions, fresh)):
+                if question is not replacement:
+                    redis_storage.set_room_question(room_id, pos, replacement)
 
-    socketio.emit("startGame", serialize_question(firstQuest, 1), to=room_id)
-    question_start_times[room_id] = time()
-    room.status = RoomStatus.QUESTION
-    socketio.start_background_task(question_timer, room_id, firstQuest.time_limit)
-    # Сохраняем обновлённую комнату в Redis
-    redis_storage.save_room(room_id, room)
+        # Игра началась — комната больше не видна в лобби
+        redis_storage.remove_lobby_room(room_id)
+        redis_storage.add_active_room(room_id)
+        # Устанавливаем позицию вопроса в Redis
+        redis_storage.set_quest_position(room_id, 0)
+        redis_storage.reset_players_answers(room_id, reset_scores=True)
+        timer_start = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+        firstQuest = redis_storage.get_question(room_id, 0)
+
+        socketio.emit("startGame", serialize_question(firstQuest, 1), to=room_id)
+        # Сохраняем обновлённые поля комнаты в Redis и ставим дедлайн вопроса
+        redis_storage.set_room_fields(room_id, timer_start=timer_start)
+        redis_storage.start_question(room_id, firstQuest)
+        redis_storage.touch_room(room_id)
 
 
 @socketio.on("answer")
@@ -235,155 +294,290 @@ def answer(data):
         socketio.emit("Error", {"message": "missing room_id or user_id"}, to=request.sid)
         print("Not room_id or user_id")
         return
-    # Получаем комнату из Redis
-    room = redis_storage.get_room(room_id)
-    if not room:
+    # Регистрируем ответ и начисляем очки атомарно в Redis
+    result = redis_storage.register_answer(room_id, user_id, answer_text)
+    if result["result"] == "room_not_found":
         socketio.emit("Error", {"message": "room not found"}, to=request.sid)
         return
-
-    if room.status != RoomStatus.QUESTION:
+    if result["result"] == "question_not_started":
+        socketio.emit("Error", {"message": "question not started"}, to=request.sid)
+        return
+    if result["result"] == "user_not_in_room":
+        socketio.emit("Error", {"message": "user not in room"}, to=request.sid)
         return
+    if result["result"] == "already_answered":
+        print("OKAK")
+        return
+    if result["result"] == "accepted":
+        if result["large"]:
+            # Ответ и новый счёт игрока уже в буфере комнаты — их разошлёт answered_batch
+            batch_added(room_id, "answered", result["batch_size"])
+        else:
+            socketio.emit("answered", {"user_id" : user_id, "correct_answered": int(result["correct"])}, to=room_id)
+        print("New answers was fixed")
+    if result["all_answered"]:
+        print(f"Все игроки ответили — завершаем вопрос досрочно в комнате {room_id}")
+
 
-    if room_locks.get(room_id) is None:
-        socketio.emit("Error", {"message": "room lock not initialized"}, to=request.sid)
+def generate_room_questions(room_id, count, topics, fallback_category_ids, token):
+    # Вопросы добавляются в комнату по мере генерации: игру можно начать, не дожидаясь всех
+    added = 0
+    # Одинаковые генерации других комнат ждут этот поток — закрываем его сразу, как он не нужен
+    stream = stream_shared_gpt_questions(count, topics)
+    try:
+        for question in stream:
+            if not redis_storage.room_exists(room_id):
+                return
+            total = redis_storage.append_room_question(room_id, question)
+            socketio.emit("questions_generated", {"count": total}, to=room_id)
+            added += 1
+            if added >= count:
+                break
+            # Аренда истекла и комнату уже добрал recovery_loop — дальше не генерируем
+            token = redis_storage.renew_generation(room_id, token, GENERATION_LEASE)
+            if not token:
+                return
+    except Exception as e:
+        print(f"Ошибка генерации вопросов для комнаты {room_id}: {e}")
+    finally:
+        stream.close()
+        token = token and redis_storage.renew_generation(room_id, token, GENERATION_LEASE)
+        if token and redis_storage.room_exists(room_id):
+            if added < count:
+                # LLM не справился — добираем вопросы из базы
+                _top_up_questions(room_id, count - added, fallback_category_ids)
+            _finish_generation(room_id, token)
+
+
+def _top_up_questions(room_id, count, category_ids):
+    fallback = db.sample_questions(count, category_ids)
+    for question in fallback['questions'] or []:
+        total = redis_storage.append_room_question(room_id, question)
+        socketio.emit("questions_generated", {"count": total}, to=room_id)
+
+
+def _finish_generation(room_id, token):
+    redis_storage.finish_generation(room_id, token)
+    redis_storage.refresh_lobby_room(room_id, question_count=redis_storage.get_questions_count(room_id))
+
+
+def recover_generations():
+    """Добирает из базы вопросы комнат, чей генератор пропал вместе с воркером."""
+    token, room_ids = redis_storage.claim_expired_generations(SCHEDULER_BATCH, GENERATION_LEASE)
+    for room_id in room_ids:
+        meta = redis_storage.get_room_meta(room_id)
+        if meta:
+            missing = int(meta.get("expected_questions", 0)) - redis_storage.get_questions_count(room_id)
+            if missing > 0:
+                _top_up_questions(room_id, missing, redis_storage.get_generation_fallback(room_id))
+        _finish_generation(room_id, token)
+    return len(room_ids)
+
+
+def start_scheduler():
+    global _scheduler_started
+    if _scheduler_started:
         return
+    _scheduler_started = True
+    socketio.start_background_task(recovery_loop)
+    socketio.start_background_task(sweeper_loop)
+    socketio.start_background_task(question_index_loop)
+    socketio.start_background_task(deadline_scheduler)
+    socketio.start_background_task(question_pool.refill_loop, socketio.sleep)
+    socketio.start_background_task(persist_loop)
+
+
+def sweeper_loop():
+    # Убираем из индексов комнаты, ключи которых истекли по TTL
+    while True:
+        socketio.sleep(SWEEP_INTERVAL)
+        # Пул соединений у каждого воркера свой — его счётчики пишет в лог каждый воркер
+        print(f"Пул MySQL воркера {os.getpid()}: {db.get_pool_stats()}")
+        try:
+            if not redis_storage.try_acquire_sweeper(SWEEP_INTERVAL):
+                continue
+            removed = redis_storage.sweep_rooms()
+            print(f"Очистка Redis: {removed}, память: {redis_storage.get_memory_stats()}, "
+                  f"рассылка: {redis_storage.get_broadcast_stats()}, "
+                  f"коды комнат: {redis_storage.get_room_code_stats()}")
+        except Exception as e:
+            print(f"Ошибка очистки Redis: {e}")
 
-    with room_locks[room_id]:
-        start_ts = question_start_times.get(room_id)
-        # Получаем позицию вопроса из Redis
-        pos = redis_storage.get_quest_position(room_id)
-        if start_ts is None or pos is None:
-            socketio.emit("Error", {"message": "question not started"}, to=request.sid)
-            return
+
+def question_index_loop():
+    # Сверка индекса вопросов с MySQL вынесена из запросов: создание комнаты только читает Redis
+    while True:
+        socketio.sleep(QUESTION_INDEX_CHECK_INTERVAL)
         try:
-            current_quest = room.questions[pos]
-        except (IndexError, TypeError):
-            socketio.emit("Error", {"message": "invalid question position"}, to=request.sid)
-            return
+            if db.question_index_stale() and \
+                    redis_storage.try_acquire_question_index_refresh(QUESTION_INDEX_CHECK_INTERVAL):
+                db.refresh_question_index()
+        except Exception as e:
+            print(f"Ошибка сверки индекса вопросов: {e}")
 
-        user = room.players.get(user_id)
-        if not user:
-            socketio.emit("Error", {"message": "user not in room"}, to=request.sid)
-            return
-        if user.answered:
-            print("OKAK")
-            return
-        
-        past_time = time() - start_ts
-        lim = getattr(current_quest, "time_limit", 0)
-        if lim <= 0:
-            user.answered = True
-            user.answer = answer_text
-            # Сохраняем обновлённую комнату в Redis
-            redis_storage.save_room(room_id, room)
-            return
-        
-        if past_time <= lim:
-            user.answered = True
-            user.answer = answer_text
-            part = lim / 4.0
-            
-            if answer_text == current_quest.correct_answer:
-                user.correct += 1
-                if 0 <= past_time < part:
-                    user.score += 60  # 10 + 50
-                elif part <= past_time < 2 * part:
-                    user.score += 35
-                elif 2 * part <= past_time < 3 * part:
-                    user.score += 20
-                else:
-                    user.score += 10
-            # Сохраняем обновлённую комнату в Redis
-            redis_storage.save_room(room_id, room)
-            socketio.emit("answered",
-                          {"user_id" : user_id, "correct_answered": int(answer_text == current_quest.correct_answer) }, to=room_id)
-            print("New answers was fixed")
-    all_answered = all(p.answered for p in room.players.values())
-    if all_answered:
-        print(f"Все игроки ответили — завершаем вопрос досрочно в комнате {room_id}")
-        room.status = RoomStatus.CHECK_CORRECT_ANSWER
-        redis_storage.save_room(room_id, room)
 
+def persist_loop():
+    # Пишем завершённые игры из Redis Stream в MySQL; конец игры не ждёт базу
+    consumer = f"{socket.gethostname()}-{os.getpid()}"
+    backoff = PERSIST_INTERVAL
+    while True:
+        socketio.sleep(backoff)
+        try:
+            redis_storage.ensure_finished_games_group()
+            redis_storage.claim_stale_finished_games(consumer, PERSIST_BATCH)
+            games = redis_storage.read_finished_games(consumer, PERSIST_BATCH)
+            # Повреждённые записи не исправятся повтором — сразу в поток недоставленных
+            redis_storage.dead_letter_finished_games([entry_id for entry_id, room in games if room is None], "corrupted")
+            games = [(entry_id, room) for entry_id, room in games if room is not None]
+            if not games:
+                backoff = PERSIST_INTERVAL
+                continue
+            if _save_finished_games(games):
+                backoff = 0 if len(games) == PERSIST_BATCH else PERSIST_INTERVAL
+            else:
+                backoff = min(max(backoff, PERSIST_INTERVAL) * 2, PERSIST_MAX_BACKOFF)
+                print(f"Не удалось сохранить часть из {len(games)} игр, повтор через {backoff} с")
+        except Exception as e:
+            backoff = min(max(backoff, PERSIST_INTERVAL) * 2, PERSIST_MAX_BACKOFF)
+            print(f"Ошибка записи завершённых игр: {e}")
 
-def question_timer(room_id, time_limit):
-    for _ in range(time_limit):
-        socketio.sleep(1)
-        room = redis_storage.get_room(room_id)
-        if not room:
-            return
-        if room.status != RoomStatus.QUESTION:
-            break
 
-    # Проверяем, не завершён ли вопрос досрочно
-    room = redis_storage.get_room(room_id)
+def _save_rooms_safely(rooms):
+    try:
+        return db.save_rooms(rooms)['success']
+    except Exception as e:
+        print(f"Ошибка сохранения игр: {e}")
+        return False
+
+
+def _save_finished_games(games):
+    """Пишет пачку игр; если пачка не записалась — по одной, чтобы одна «ядовитая» игра
+    не держала остальные. Возвращает True, если записаны все."""
+    if _save_rooms_safely([room for _, room in games]):
+        redis_storage.ack_finished_games([entry_id for entry_id, _ in games])
+        return True
+    saved, failed = [], []
+    for entry_id, room in games:
+        (saved if _save_rooms_safely([room]) else failed).append(entry_id)
+    redis_storage.ack_finished_games(saved)
+    if failed and db.ping():
+        # База отвечает, а игра не пишется — считаем попытки; при недоступной базе не считаем,
+        # иначе простой MySQL отправил бы в недоставленные все игры подряд
+        attempts = redis_storage.record_finished_game_failures(failed)
+        dead = [entry_id for entry_id, count in attempts.items() if count >= PERSIST_MAX_ATTEMPTS]
+        if dead:
+            print(f"Игры {dead} не записаны за {PERSIST_MAX_ATTEMPTS} попыток — перенесены в недоставленные")
+            redis_storage.dead_letter_finished_games(dead, "save_failed")
+    return not failed
+
+
+def recovery_loop():
+    # Подхватываем игры, чьи дедлайны потерял упавший или перезапущенный воркер
+    while True:
+        try:
+            requeued = redis_storage.requeue_stale_deadlines()
+            adopted = redis_storage.adopt_orphaned_rooms()
+            generations = recover_generations()
+            if requeued or adopted or generations:
+                print(f"Восстановлено комнат: {requeued + adopted + generations}")
+        except Exception as e:
+            print(f"Ошибка восстановления комнат: {e}")
+        socketio.sleep(RECOVERY_INTERVAL)
+
+
+def deadline_scheduler():
+    while True:
+        try:
+            for room_id, token in redis_storage.claim_due_deadlines(SCHEDULER_BATCH):
+                socketio.start_background_task(handle_deadline, room_id, token)
+        except Exception as e:
+            print(f"Ошибка планировщика дедлайнов: {e}")
+        socketio.sleep(SCHEDULER_TICK)
+
 
+def handle_deadline(room_id, token):
+    try:
+        with redis_storage.room_lock(room_id):
+            status = redis_storage.get_room_status(room_id)
+            if status == RoomStatus.QUESTION:
+                close_question(room_id)
+            elif status == RoomStatus.CHECK_CORRECT_ANSWER:
+                next_question({"room_id": room_id})
+    except Exception as e:
+        print(f"Ошибка обработки дедлайна комнаты {room_id}: {e}")
+        # Повторим чуть позже, чтобы игра не зависла
+        redis_storage.schedule_deadline(room_id, 1)
+    finally:
+        redis_storage.ack_deadline(room_id, token)
+
+
+def close_question(room_id):
     # Получаем позицию вопроса из Redis
     pos = redis_storage.get_quest_position(room_id)
     if pos is None:
         return
 
-    current_question = room.questions[pos]
+    current_question = redis_storage.get_question(room_id, pos)
     correct_answer = current_question.correct_answer
 
-    sleeptime = 5
-    room.status = RoomStatus.CHECK_CORRECT_ANSWER
+    sleeptime = SHOW_ANSWER_TIME
+    # Сначала закрываем приём ответов, затем забираем буфер всех воркеров:
+    # после смены статуса новые ответы в него не попадут, и все накопленные
+    # дойдут до показа правильного ответа
+    redis_storage.set_room_status(room_id, RoomStatus.CHECK_CORRECT_ANSWER)
+    flush_batch(room_id, "answered")
     socketio.emit("show_correct_answer", {"correct_answer": correct_answer, "sleep_timer" : sleeptime}, to=room_id)
-    socketio.emit("need_update_leaderboard", to=room_id)
-    redis_storage.save_room(room_id,room)
-
-    socketio.sleep(sleeptime)
-
-    with room_locks[room_id]:
-        next_question({"room_id": room_id})
+    if redis_storage.is_large_room(room_id):
+        # Тысячи клиентов не запрашивают таблицу сами: один раз рассылаем первые места
+        socketio.emit("update_leaderboard", redis_storage.get_leaderboard(room_id, LEADERBOARD_TOP), to=room_id)
+    else:
+        socketio.emit("need_update_leaderboard", to=room_id)
+    redis_storage.schedule_deadline(room_id, sleeptime)
 
 
 def next_question(data):
     room_id = data['room_id']
-    # Получаем комнату из Redis
-    room = redis_storage.get_room(room_id)
-
-    if room is None:
+    if not redis_storage.room_exists(room_id):
         socketio.emit("Error", "This room doesn't exist", to=request.sid)
         return
-    questions = room.questions
+    questions_count = redis_storage.get_questions_count(room_id)
 
-    for p in room.players.values():
-        p.answered=False
-        p.answer=""
-
-    redis_storage.save_room(room_id, room)
+    redis_storage.reset_players_answers(room_id)
     # Получаем позицию вопроса из Redis
     pos = redis_storage.get_quest_position(room_id)
     if pos is None:
         socketio.emit("Error", "Quest position not found", to=room_id)
         return
 
-    if pos == len(questions) - 1:
-        room.status = RoomStatus.FINISHED
-        # Сохраняем обновлённую комнату в Redis
-        room.timer_end = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        redis_storage.save_room(room_id, room)
+    if pos == questions_count - 1 and redis_storage.is_generating(room_id):
+        # Следующий вопрос ещё генерируется — проверим снова через секунду
+        redis_storage.schedule_deadline(room_id, 1)
+        return
+
+    if pos == questions_count - 1:
+        # Сохраняем обновлённые поля комнаты в Redis
+        redis_storage.set_room_fields(room_id, status=RoomStatus.FINISHED,
+                                      timer_end=datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+        room = redis_storage.get_room(room_id)
         print(room)
-        db.save_room(room)
+        # В MySQL игру запишет persist_loop
+        redis_storage.enqueue_finished_game(room)
         # Удаляем комнату из списка активных
         redis_storage.remove_active_room(room_id)
         socketio.emit("endOfGame", to=room_id)
         # Удаляем позицию вопроса из Redis
         redis_storage.delete_quest_position(room_id)
-        # Убираем локальные данные
-        question_start_times.pop(room_id, None)
-        room_locks.pop(room_id, None)
+        # Результаты доступны ещё FINISHED_ROOM_TTL, затем комната истекает
+        redis_storage.touch_room(room_id, redis_storage.FINISHED_ROOM_TTL)
         return
     else:
         next_question_position = pos + 1
-        next_quest = questions[next_question_position]
+        next_quest = redis_storage.get_question(room_id, next_question_position)
         # Обновляем позицию вопроса в Redis
         redis_storage.set_quest_position(room_id, next_question_position)
         socketio.emit("get_quest", serialize_question(next_quest, pos+2), to=room_id)
-        question_start_times[room_id] = time()
-        room.status = RoomStatus.QUESTION
-        redis_storage.save_room(room_id, room)
-        socketio.start_background_task(question_timer, room_id, next_quest.time_limit)
+        redis_storage.start_question(room_id, next_quest)
+        redis_storage.touch_room(room_id)
 
 
 
@@ -394,55 +588,86 @@ def next_question(data):
 @socketio.on("show_result")
 def show_results(data):
     room_id = data['room_id']
-    # Получаем комнату из Redis
-    room = redis_storage.get_room(room_id)
-    if not room:
+    # Таблица лидеров — sorted set в Redis, уже упорядочена по очкам
+    if not redis_storage.room_exists(room_id):
         socketio.emit("Error", "Room not found", to=request.sid)
         return
-    res = []
-    players = room.players.values()
-    for i in players:
-        r = {
-            "user_id": i.user_id,
-            "username": i.username,
-            "score": i.score
-        }
-        res.append(r)
-    res.sort(key=lambda x: x['score'], reverse=True)
-    socketio.emit("result", res, to=room_id)
+    if redis_storage.is_large_room(room_id):
+        socketio.emit("result", redis_storage.get_leaderboard(room_id, LEADERBOARD_TOP), to=request.sid)
+        emit_player_rank(room_id, data.get('user_id'))
+        return
+    socketio.emit("result", redis_storage.get_leaderboard(room_id), to=room_id)
 
 
 @socketio.on("update_leaderboard")
 def update_leaderboard(data):
     room_id = data['room_id']
-    # Получаем комнату из Redis
-    room = redis_storage.get_room(room_id)
-    if not room:
+    if not redis_storage.room_exists(room_id):
         socketio.emit("Error", "Room not found", to=room_id)
         return
+    if redis_storage.is_large_room(room_id):
+        # Большая комната: первые места и своё место — только запросившему
+        socketio.emit("update_leaderboard", redis_storage.get_leaderboard(room_id, LEADERBOARD_TOP), to=request.sid)
+        emit_player_rank(room_id, data.get('user_id'))
+        return
+    socketio.emit("update_leaderboard", redis_storage.get_leaderboard(room_id), to=room_id)
+
 
-    res = []
-    players = room.players.values()
-    for i in players:
-        r = {
-            "user_id": i.user_id,
-            "username": i.username,
-            "score": i.score
-        }
-        res.append(r)
-    res.sort(key=lambda x: [x['score']], reverse=True)
-    socketio.emit("update_leaderboard", res, to=room_id)
+@socketio.on("leaderboard_rank")
+def leaderboard_rank(data):
+    emit_player_rank(data['room_id'], data.get('user_id'))
+
+
+def emit_player_rank(room_id, user_id):
+    if not user_id:
+        sid_data = redis_storage.get_request_sid_data(request.sid)
+        user_id = sid_data[0] if sid_data else None
+    rank = redis_storage.get_player_rank(room_id, user_id) if user_id else None
+    if rank is None:
+        socketio.emit("Error", {"message": "This user is not in room"}, to=request.sid)
+        return
+    socketio.emit("leaderboard_rank", rank, to=request.sid)
+
+
+def lobby_players(room_id):
+    # Получаем метаданные и игроков комнаты из Redis
+    meta = redis_storage.get_room_meta(room_id)
+    if meta is None:
+        return None
+    large = meta.get("large") == "1"
+    # В большой комнате отправляем только первых игроков и общее число
+    room_players = redis_storage.get_players(room_id, redis_storage.get_player_ids(room_id, LEADERBOARD_TOP)
+                                             if large else None)
+    owner = redis_storage.owner_from_meta(meta, {p.user_id: p for p in room_players})
+    players = {"players": serialize_players(room_players),
+               "owner": serialize_player(owner),
+               "players_count": redis_storage.get_players_count(room_id) if large else len(room_players)}
+    return players
 
 
 @socketio.on("all_players_in_lobby")
 def all_players_in_lobby(data):
     room_id = data['room_id']
-    # Получаем комнату из Redis
-    room = redis_storage.get_room(room_id)
-    if room is None:
+    players = lobby_players(room_id)
+    if players is None:
         socketio.emit("Error", {"message": "Room not found"}, to=request.sid)
         return
-    players = {"players": serialize_players(room.players.values()),
-               "owner": serialize_player(room.owner)}
     print(f"Emitting to room {room_id}, players: {len(players['players'])}")
     socketio.emit("all_players_in_lobby", players, to=room_id)
+
+
+def lobby_changed(room_id, large=None):
+    """Рассылает состав лобби; в большой комнате входы и выходы за окно сливаются в одну рассылку."""
+    if large is None:
+        large = redis_storage.is_large_room(room_id)
+    if not large:
+        all_players_in_lobby({"room_id": room_id})
+    elif redis_storage.try_schedule_lobby_broadcast(room_id, LOBBY_BROADCAST_WINDOW):
+        socketio.start_background_task(_broadcast_lobby_later, room_id)
+
+
+def _broadcast_lobby_later(room_id):
+    socketio.sleep(LOBBY_BROADCAST_WINDOW)
+    players = lobby_players(room_id)
+    if players is not None:
+        socketio.emit("all_players_in_lobby", players, to=room_id)
@@ -0,0 +1,157 @@
+"""Микробенчмарки горячих путей игры в зависимости от размера комнаты.
+
+Замеряются запись и чтение комнаты (``redis_storage.save_room``/``get_room``),
+сериализация вопроса и игроков для Socket.IO, начисление очков за ответ
+(``register_answer`` — то, что делает обработчик ``answer``), таблица лидеров
+(``get_leaderboard`` — целиком и первые места) и выборка вопросов для комнаты
+(``db.get_questions``). Redis заменён на fakeredis, MySQL — на SQLite в памяти,
+как в bench_question_sampling.py, поэтому сравнивать стоит прогоны между собой
+на одной машине, а не с продакшеном.
+
+    python benchmarks/bench_hot_paths.py --sizes 10 100 1000 > baseline.json
+    # после изменений: завершится с кодом 1, если что-то стало медленнее чем в 1.25 раза
+    python benchmarks/bench_hot_paths.py --sizes 10 100 1000 --baseline baseline.json
+"""
+import argparse
+import json
+import platform
+import statistics
+import sys
+import time
+import uuid
+from datetime import datetime, timezone
+
+from bench_question_sampling import build_bank, fakeredis, sqlite_get_from_bd
+from app import db, redis_storage
+from app.models import Player, Question, Room, RoomStatus
+from app.sockets import serialize_players, serialize_question
+
+CATEGORY_IDS = ["cat-1", "cat-2", "cat-3"]
+# Комнаты больше этого размера создаются как большие (large)
+LARGE_ROOM_FROM = 100
+
+
+def measure(fn, iterations, ops=1):
+    """Время одного вызова fn в микросекундах; ops — сколько операций делает один вызов."""
+    timings = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - started) * 1_000_000 / ops)
+    timings.sort()
+    return {"mean_us": round(statistics.mean(timings), 2),
+            "p50_us": round(timings[len(timings) // 2], 2),
+            "p95_us": round(timings[max(int(len(timings) * 0.95) - 1, 0)], 2)}
+
+
+def make_room(players_count, questions_count):
+    players = {}
+    for i in range(players_count):
+        player = Player(user_id=uuid.uuid4().hex, username=f"player-{i}", score=(i * 37) % 500, correct=i % 7)
+        players[player.user_id] = player
+    questions = [Question(id=str(uuid.uuid4()), text=f"Вопрос {i}", options=["a", "b", "c", "d"],
+                          correct_answer="a", time_limit=30, category_id=CATEGORY_IDS[0])
+                 for i in range(questions_count)]
+    return Room(room_id=str(uuid.uuid4()), owner=next(iter(players.values())), players=players,
+                questions=questions, status=RoomStatus.WAITING, max_players=players_count,
+                room_code=uuid.uuid4().hex[:6].upper(), timer_start=datetime.now(timezone.utc),
+                large=players_count > LARGE_ROOM_FROM)
+
+
+def answer_round(room):
+    """Один вопрос: все игроки отвечают, половина — правильно."""
+    redis_storage.reset_players_answers(room.room_id)
+    redis_storage.start_question(room.room_id, room.questions[0])
+    for i, user_id in enumerate(room.players):
+        result = redis_storage.register_answer(room.room_id, user_id, "a" if i % 2 else "b")
+        if result["result"] != "accepted":
+            raise RuntimeError(f"Ответ не принят: {result['result']}")
+
+
+def bench_room(players_count, questions_count, iterations):
+    room = make_room(players_count, questions_count)
+    room_id = room.room_id
+    redis_storage.save_room(room_id, room)
+    results = {
+        "save_room": measure(lambda: redis_storage.save_room(room_id, room), iterations),
+        "get_room": measure(lambda: redis_storage.get_room(room_id), iterations),
+        "serialize_question": measure(lambda: serialize_question(room.questions[0], 1), iterations),
+        "serialize_players": measure(lambda: serialize_players(room.players.values()), iterations),
+        # Прежний путь update_leaderboard: все игроки из Redis и сортировка в Python
+        "leaderboard_sort_players": measure(
+            lambda: sorted(serialize_players(redis_storage.get_players(room_id)), key=lambda p: p["score"],
+                           reverse=True), iterations),
+        "get_leaderboard": measure(lambda: redis_storage.get_leaderboard(room_id), iterations),
+        "get_leaderboard_top": measure(lambda: redis_storage.get_leaderboard(room_id, 10), iterations),
+        "register_answer": measure(lambda: answer_round(room), iterations, ops=players_count),
+    }
+    redis_storage.delete_room(room_id)
+    return results
+
+
+def bench_sampling(bank_size, count, iterations):
+    conn = build_bank(bank_size)
+    db.get_from_bd = sqlite_get_from_bd(conn)
+    redis_storage.r.flushdb()
+    db._question_cache.clear()
+    db.warm_question_cache()
+    user_ids = [uuid.uuid4().hex for _ in range(5)]
+    seen = db.sample_question_ids(count * 10, list(CATEGORY_IDS))
+    redis_storage.mark_questions_seen(user_ids, seen)
+    results = {
+        "get_questions": measure(lambda: db.get_questions(count, list(CATEGORY_IDS)), iterations),
+        "get_questions_seen_filter": measure(lambda: db.get_questions(count, list(CATEGORY_IDS), user_ids),
+                                             iterations),
+    }
+    conn.close()
+    return results
+
+
+def compare(report, baseline, tolerance):
+    """Замеры, ставшие медленнее базовых больше чем в tolerance раз (по медиане)."""
+    regressions = []
+    for section in ("rooms", "sampling"):
+        old = {entry["size"]: entry["results"] for entry in baseline.get(section, [])}
+        for entry in report[section]:
+            for name, timing in entry["results"].items():
+                base = old.get(entry["size"], {}).get(name)
+                if base and base["p50_us"] and timing["p50_us"] / base["p50_us"] > tolerance:
+                    regressions.append({"section": section, "size": entry["size"], "name": name,
+                                        "baseline_p50_us": base["p50_us"], "p50_us": timing["p50_us"],
+                                        "ratio": round(timing["p50_us"] / base["p50_us"], 2)})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000], help='игроков в комнате')
+    parser.add_argument('--questions', type=int, default=10, help='вопросов в комнате')
+    parser.add_argument('--bank-sizes', type=int, nargs='+', default=[10_000, 100_000])
+    parser.add_argument('--count', type=int, default=10, help='вопросов в выборке')
+    parser.add_argument('--iterations', type=int, default=30)
+    parser.add_argument('--baseline', help='JSON прошлого прогона для сравнения')
+    parser.add_argument('--tolerance', type=float, default=1.25)
+    args = parser.parse_args()
+
+    if fakeredis is None:
+        sys.exit('Нужен fakeredis: pip install "fakeredis[lua]"')
+
+    report = {
+        "benchmark": "hot_paths",
+        "python": platform.python_version(),
+        "config": {"questions": args.questions, "count": args.count, "iterations": args.iterations},
+        "rooms": [{"size": size, "results": bench_room(size, args.questions, args.iterations)}
+                  for size in args.sizes],
+        "sampling": [{"size": size, "results": bench_sampling(size, args.count, args.iterations)}
+                     for size in args.bank_sizes],
+    }
+    if args.baseline:
+        with open(args.baseline) as f:
+            report["regressions"] = compare(report, json.load(f), args.tolerance)
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    if report.get("regressions"):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
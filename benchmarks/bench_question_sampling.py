@@ -0,0 +1,126 @@
+"""Задержка выборки вопросов для комнаты в зависимости от размера банка вопросов.
+
+Сравнивает старый запрос ``ORDER BY RAND() LIMIT n`` с выборкой по индексу id
+(``db.sample_questions``) — с пустым и с прогретым кэшем вопросов. Вместо MySQL
+используется SQLite в памяти, вместо Redis — fakeredis (если установлен), поэтому
+важны не абсолютные числа, а то, как время растёт с размером таблицы.
+
+    python benchmarks/bench_question_sampling.py --sizes 10000 100000 1000000
+"""
+import argparse
+import json
+import os
+import sqlite3
+import statistics
+import sys
+import time
+import uuid
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('API_KEY', 'benchmark')
+os.environ.setdefault('REDIS_HOST', 'localhost')
+os.environ.setdefault('REDIS_PORT', '6379')
+
+try:
+    import fakeredis
+    import redis
+except ImportError:
+    fakeredis = None
+else:
+    # Подменяем клиент до импорта приложения: Lua-скрипты регистрируются при импорте
+    _fake_server = fakeredis.FakeServer()
+
+    class SharedFakeRedis(fakeredis.FakeRedis):
+        """Все клиенты, включая очередь сообщений Socket.IO (from_url), работают с одним сервером."""
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(server=_fake_server)
+
+        @classmethod
+        def from_url(cls, url, **kwargs):
+            return cls()
+
+    redis.Redis = SharedFakeRedis
+
+from app import db  # noqa: E402
+
+CATEGORIES = 20
+
+
+def build_bank(size):
+    conn = sqlite3.connect(':memory:', check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    # Подписи категорий в индексе вопросов считаются через CRC32, как в MySQL
+    conn.create_function("CRC32", 1, lambda value: zlib.crc32(str(value).encode()))
+    conn.execute("CREATE TABLE questions (id TEXT PRIMARY KEY, category_id TEXT, text TEXT, "
+                 "options TEXT, correct_answer TEXT, time_limit INTEGER)")
+    conn.execute("CREATE INDEX questions_category ON questions (category_id)")
+    options = json.dumps({"list": ["a", "b", "c", "d"]})
+    conn.executemany("INSERT INTO questions VALUES (?,?,?,?,?,?)",
+                     ((str(uuid.uuid4()), f"cat-{i % CATEGORIES}", f"Вопрос {i}", options, "a", 30)
+                      for i in range(size)))
+    conn.commit()
+    return conn
+
+
+def sqlite_get_from_bd(conn):
+    def get_from_bd(sql, params=None, one_row=False):
+        rows = [dict(row) for row in conn.execute(sql.replace('%s', '?'), params or ())]
+        if not rows:
+            return None
+        return rows[0] if one_row else rows
+    return get_from_bd
+
+
+def order_by_rand(conn, count, category_ids):
+    placeholders = ', '.join(['?'] * len(category_ids))
+    return conn.execute(f"SELECT * FROM questions WHERE category_id in ({placeholders}) "
+                        f"ORDER BY RANDOM() LIMIT ?", (*category_ids, count)).fetchall()
+
+
+def cold_sample(count, category_ids):
+    db._question_cache.clear()
+    return db.sample_questions(count, list(category_ids))
+
+
+def measure(fn, iterations):
+    timings = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - started) * 1000)
+    return {"mean_ms": round(statistics.mean(timings), 3),
+            "p95_ms": round(sorted(timings)[int(len(timings) * 0.95) - 1], 3)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    parser.add_argument('--count', type=int, default=10)
+    parser.add_argument('--iterations', type=int, default=50)
+    args = parser.parse_args()
+
+    category_ids = ["cat-1", "cat-2", "cat-3"]
+    results = []
+    for size in args.sizes:
+        conn = build_bank(size)
+        db.get_from_bd = sqlite_get_from_bd(conn)
+        db.redis_storage.r.flushdb()
+        db._question_cache.clear()
+        started = time.perf_counter()
+        db.warm_question_cache()
+        warm_up_ms = (time.perf_counter() - started) * 1000
+        results.append({
+            "bank_size": size,
+            "warm_up_ms": round(warm_up_ms, 3),
+            "order_by_rand": measure(lambda: order_by_rand(conn, args.count, category_ids), args.iterations),
+            "indexed_sample": measure(lambda: cold_sample(args.count, category_ids), args.iterations),
+            "cached_sample": measure(lambda: db.sample_questions(args.count, list(category_ids)), args.iterations),
+        })
+        conn.close()
+    print(json.dumps({"benchmark": "question_sampling", "count": args.count, "results": results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""Пропускная способность входа и задержка event loop при пачке логинов под eventlet.
+
+Сравнивает проверку пароля прямо в green-потоке (inline) с пулом настоящих
+потоков (pool). Параллельно работает «пульс» — green-поток, который каждые
+10 мс засыпает и меряет, насколько опоздал: так видно, как bcrypt замораживает
+сокеты остальных игроков.
+
+    python benchmarks/bench_signin.py --logins 64 --rounds 12
+"""
+import eventlet
+
+# Сеть бенчмарку не нужна — патчим только потоки и time, этого достаточно для bcrypt
+eventlet.monkey_patch(thread=True, time=True)
+
+import argparse  # noqa: E402
+import json  # noqa: E402
+import sys  # noqa: E402
+import time  # noqa: E402
+
+import bcrypt  # noqa: E402
+
+# Импорт подменяет redis.Redis на fakeredis: вход кэширует имя пользователя в Redis
+from bench_question_sampling import fakeredis  # noqa: E402
+from app import db  # noqa: E402
+
+PASSWORD = 'correct horse battery staple'
+
+
+def heartbeat(lags, stop, interval=0.01):
+    while not stop:
+        started = time.monotonic()
+        eventlet.sleep(interval)
+        lags.append((time.monotonic() - started - interval) * 1000)
+
+
+def run(mode, logins):
+    in_green_thread = db._in_green_thread
+    if mode == 'inline':
+        db._in_green_thread = lambda: False
+    lags, stop = [], []
+    beat = eventlet.spawn(heartbeat, lags, stop)
+    eventlet.sleep(0.05)
+    pool = eventlet.GreenPool(logins)
+    started = time.monotonic()
+    results = list(pool.imap(lambda _: db.sign_in('user', PASSWORD), range(logins)))
+    elapsed = time.monotonic() - started
+    stop.append(True)
+    beat.wait()
+    db._in_green_thread = in_green_thread
+    lags.sort()
+    return {
+        "logins_per_sec": round(logins / elapsed, 2),
+        "succeeded": sum(1 for result in results if result['success']),
+        "rejected": sum(1 for result in results if result.get('busy')),
+        "loop_lag_p50_ms": round(lags[len(lags) // 2], 3) if lags else None,
+        "loop_lag_max_ms": round(lags[-1], 3) if lags else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--logins', type=int, default=32)
+    parser.add_argument('--rounds', type=int, default=db.BCRYPT_ROUNDS)
+    args = parser.parse_args()
+
+    if fakeredis is None:
+        sys.exit('Нужен fakeredis: pip install "fakeredis[lua]"')
+
+    password_hash = bcrypt.hashpw(PASSWORD.encode('utf-8'), bcrypt.gensalt(rounds=args.rounds)).decode('utf-8')
+    user = {'id': 'user-id', 'username': 'user', 'password_hash': password_hash}
+    db.get_from_bd = lambda sql, params=None, one_row=False: user
+    results = {mode: run(mode, args.logins) for mode in ('inline', 'pool')}
+    print(json.dumps({"benchmark": "signin", "logins": args.logins, "rounds": args.rounds,
+                      "workers": db.BCRYPT_WORKERS, "results": results,
+                      "bcrypt_stats": db.get_bcrypt_stats()}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,416 @@
+"""Нагрузочный тест: N комнат × M игроков проходят полную игру через REST и Socket.IO.
+
+Каждый игрок регистрируется и входит через REST (app/routes.py), владелец создаёт
+комнату, остальные входят по коду, затем все подключаются по Socket.IO и играют:
+join_room → start_quiz → answer на каждый вопрос → endOfGame. В отчёте (JSON):
+перцентили задержек REST-запросов и событий, потерянные события, ошибки сервера
+и загрузка CPU процесса сервера.
+
+Задержки событий:
+    start_to_first_question  — start_quiz владельца → startGame у игрока
+    question_skew            — насколько позже первого игрока комнаты вопрос дошёл до остальных
+    answer_ack               — answer → своё событие answered / answered_batch
+
+Зависимости клиента и стендов: pip install -r benchmarks/requirements.txt
+
+    # Сервер из create_app() под eventlet со стендами (fakeredis вместо Redis, SQLite вместо MySQL)
+    # в отдельном процессе
+    python benchmarks/loadtest.py --self-host --rooms 20 --players 10
+    # Против уже запущенного сервера; CPU считается по указанным PID (вместе с дочерними)
+    python benchmarks/loadtest.py --url http://localhost:5001 --category-id <id> --rooms 50 --server-pid 1234
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import uuid
+from collections import Counter, defaultdict
+
+PASSWORD = 'loadtest-password'
+
+
+def percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+
+    def pick(q):
+        return round(values[min(int(len(values) * q), len(values) - 1)], 3)
+    return {"count": len(values), "p50_ms": pick(0.5), "p90_ms": pick(0.9), "p99_ms": pick(0.99),
+            "max_ms": round(values[-1], 3)}
+
+
+class Stats:
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.counters = Counter()
+
+    def add(self, name, seconds):
+        self.samples[name].append(seconds * 1000)
+
+    def report(self):
+        return {"latency": {name: percentiles(values) for name, values in sorted(self.samples.items())},
+                "counters": dict(sorted(self.counters.items()))}
+
+
+# CPU процесса сервера по /proc (Linux): utime + stime процесса и его потомков
+def _proc_children(pid):
+    children = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == pid:
+            children.append(int(entry))
+    return children
+
+
+def cpu_seconds(pids):
+    total = 0.0
+    seen = set()
+    stack = list(pids)
+    while stack:
+        pid = stack.pop()
+        if pid in seen:
+            continue
+        seen.add(pid)
+        try:
+            with open(f'/proc/{pid}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        total += (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+        stack.extend(_proc_children(pid))
+    return total
+
+
+class RoomState:
+    def __init__(self):
+        self.room_id = None
+        self.start_sent_at = None
+        # позиция вопроса -> время получения каждым игроком
+        self.question_times = defaultdict(list)
+        self.total_questions = 0
+
+
+class SimPlayer:
+    def __init__(self, args, name, room, stats):
+        import httpx
+        import socketio
+
+        self.args = args
+        self.name = name
+        self.room = room
+        self.stats = stats
+        self.user_id = None
+        self.http = httpx.AsyncClient(base_url=args.url, timeout=args.request_timeout)
+        self.sio = socketio.AsyncClient(reconnection=False)
+        self.positions = set()
+        self.answer_sent_at = None
+        self.finished = asyncio.Event()
+        self._register_handlers()
+
+    async def request(self, metric, method, path, **kwargs):
+        while True:
+            started = time.perf_counter()
+            resp = await self.http.request(method, path, **kwargs)
+            self.stats.add(metric, time.perf_counter() - started)
+            if resp.status_code != 503:
+                return resp
+            # Сервер занят (очередь bcrypt) — ждём, как просит Retry-After
+            self.stats.counters[f"{metric}_busy"] += 1
+            await asyncio.sleep(float(resp.headers.get('Retry-After', '1')))
+
+    async def login(self):
+        await self.request('rest_signup', 'POST', '/api/user/signup', json={'login': self.name, 'password': PASSWORD})
+        resp = await self.request('rest_signin', 'POST', '/api/user/signin',
+                                  json={'login': self.name, 'password': PASSWORD})
+        resp.raise_for_status()
+        resp = await self.request('rest_me', 'GET', '/api/user/me')
+        resp.raise_for_status()
+        self.user_id = resp.json()['user_id']
+
+    async def connect(self):
+        cookie = '; '.join(f'{key}={value}' for key, value in self.http.cookies.items())
+        await self.sio.connect(self.args.url, headers={'Cookie': cookie}, transports=[self.args.transport])
+        await self.sio.emit('join_room', {'room_id': self.room.room_id, 'user_id': self.user_id})
+
+    async def close(self):
+        if self.sio.connected:
+            await self.sio.disconnect()
+        await self.http.aclose()
+
+    def _register_handlers(self):
+        sio = self.sio
+
+        @sio.on('startGame')
+        async def on_start(question):
+            if self.room.start_sent_at is not None:
+                self.stats.add('start_to_first_question', time.perf_counter() - self.room.start_sent_at)
+            self.on_question(question)
+
+        @sio.on('get_quest')
+        async def on_question(question):
+            self.on_question(question)
+
+        @sio.on('answered')
+        async def on_answered(data):
+            self.on_answered([data])
+
+        @sio.on('answered_batch')
+        async def on_answered_batch(items):
+            self.stats.counters['answered_batches'] += 1
+            self.on_answered(items)
+
+        @sio.on('show_correct_answer')
+        async def on_correct(_):
+            self.stats.counters['show_correct_answer'] += 1
+
+        @sio.on('endOfGame')
+        async def on_end(*_):
+            self.finished.set()
+
+        @sio.on('Error')
+        async def on_error(data):
+            self.stats.counters['server_errors'] += 1
+            if self.args.verbose:
+                print(f'{self.name}: {data}', file=sys.stderr)
+
+    def on_question(self, question):
+        received = time.perf_counter()
+        position = question['position']
+        self.positions.add(position)
+        self.room.question_times[position].append(received)
+        self.room.total_questions = max(self.room.total_questions, position)
+        asyncio.ensure_future(self.answer(question))
+
+    async def answer(self, question):
+        limit = question.get('time_limit') or self.args.answer_delay
+        await asyncio.sleep(random.uniform(0, min(self.args.answer_delay, limit * 0.8)))
+        if random.random() < self.args.accuracy:
+            answer = question['correct_answer']
+        else:
+            answer = random.choice(question['options'])
+        self.answer_sent_at = time.perf_counter()
+        await self.sio.emit('answer', {'room_id': self.room.room_id, 'user_id': self.user_id, 'answer': answer})
+
+    def on_answered(self, items):
+        for item in items:
+            if item.get('user_id') == self.user_id and self.answer_sent_at is not None:
+                self.stats.add('answer_ack', time.perf_counter() - self.answer_sent_at)
+                self.answer_sent_at = None
+
+
+async def run_room(index, args, run_id, stats, rest_slots):
+    room = RoomState()
+    players = [SimPlayer(args, f'lt-{run_id}-{index}-{i}', room, stats) for i in range(args.players)]
+    owner = players[0]
+    try:
+        async def login(player):
+            async with rest_slots:
+                await player.login()
+        await asyncio.gather(*(login(player) for player in players))
+
+        resp = await owner.request('rest_create_room', 'POST', '/api/rooms/create',
+                                   json={'count_questions': args.questions, 'category_ids': [args.category_id]})
+        resp.raise_for_status()
+        room.room_id = resp.json()['room_id']
+        code = resp.json()['room_code']
+        for player in players[1:]:
+            resp = await player.request('rest_join_room', 'POST', '/api/rooms/join', json={'code': code})
+            resp.raise_for_status()
+
+        await asyncio.gather(*(player.connect() for player in players))
+        await asyncio.sleep(args.lobby_wait)
+        room.start_sent_at = time.perf_counter()
+        await owner.sio.emit('start_quiz', {'room_id': room.room_id, 'user_id': owner.user_id})
+        done, _ = await asyncio.wait([asyncio.ensure_future(player.finished.wait()) for player in players],
+                                     timeout=args.game_timeout)
+
+        stats.counters['rooms_completed' if len(done) == len(players) else 'rooms_timed_out'] += 1
+        stats.counters['end_of_game_missing'] += len(players) - len(done)
+        for player in players:
+            stats.counters['questions_missing'] += room.total_questions - len(player.positions)
+        for times in room.question_times.values():
+            first = min(times)
+            for received in times:
+                stats.add('question_skew', received - first)
+    except Exception as e:
+        stats.counters['rooms_failed'] += 1
+        print(f'Комната {index}: {type(e).__name__}: {e}', file=sys.stderr)
+    finally:
+        await asyncio.gather(*(player.close() for player in players), return_exceptions=True)
+
+
+async def run(args, server_pids):
+    import httpx
+
+    if args.category_id is None:
+        # Без явной категории берём первую из списка (нужен вход любого пользователя)
+        async with httpx.AsyncClient(base_url=args.url, timeout=args.request_timeout) as http:
+            await http.post('/api/user/signup', json={'login': 'lt-probe', 'password': PASSWORD})
+            (await http.post('/api/user/signin', json={'login': 'lt-probe', 'password': PASSWORD})).raise_for_status()
+            args.category_id = (await http.get('/api/categories/list')).json()['categories'][0]['id']
+
+    stats = Stats()
+    run_id = uuid.uuid4().hex[:8]
+    rest_slots = asyncio.Semaphore(args.concurrency)
+    cpu_before = cpu_seconds(server_pids)
+    started = time.perf_counter()
+
+    async def staggered(index):
+        await asyncio.sleep(index * args.ramp_up / max(args.rooms, 1))
+        await run_room(index, args, run_id, stats, rest_slots)
+    await asyncio.gather(*(staggered(index) for index in range(args.rooms)))
+
+    elapsed = time.perf_counter() - started
+    cpu_used = cpu_seconds(server_pids) - cpu_before
+    return {
+        "benchmark": "loadtest",
+        "config": {"rooms": args.rooms, "players": args.players, "questions": args.questions,
+                   "answer_delay": args.answer_delay, "transport": args.transport},
+        "duration_s": round(elapsed, 3),
+        "server_cpu": {"pids": server_pids, "cpu_seconds": round(cpu_used, 3),
+                       "cpu_percent": round(cpu_used / elapsed * 100, 1) if elapsed else None} if server_pids else None,
+        **stats.report(),
+    }
+
+
+def serve(port, bank_size):
+    """Приложение из create_app() под eventlet, как в gunicorn -k eventlet.
+
+    Стенды: fakeredis вместо Redis и очереди сообщений Socket.IO, SQLite вместо MySQL.
+    """
+    # httpcore (клиент OpenAI) при импорте пробует trio, а тот падает на select без epoll
+    # после monkey_patch, поэтому импортируется до него
+    import httpcore  # noqa: F401
+    import eventlet
+    eventlet.monkey_patch()
+
+    import sqlite3
+    from threading import Lock
+
+    os.environ.setdefault('JWT_SECRET_KEY', 'loadtest-secret-key-loadtest-secret-key')
+    os.environ.setdefault('BCRYPT_ROUNDS', '4')
+    # Пул GPT-вопросов стенду не нужен: без ключа OpenAI пополнение только шумит в логах
+    os.environ.setdefault('GPT_POOL_MIN', '0')
+    # Импорт подменяет redis.Redis на fakeredis и даёт SQLite-банк вопросов
+    from bench_question_sampling import build_bank
+    from app import create_app, db, socketio
+
+    conn = build_bank(bank_size)
+    conn.execute("CREATE TABLE categories (id TEXT PRIMARY KEY, name TEXT)")
+    conn.executemany("INSERT INTO categories VALUES (?, ?)", ((f"cat-{i}", f"Категория {i}") for i in range(20)))
+    conn.execute("CREATE TABLE users (id TEXT PRIMARY KEY DEFAULT (lower(hex(randomblob(16)))), "
+                 "username TEXT UNIQUE, password_hash TEXT)")
+    conn.commit()
+    lock = Lock()
+
+    def get_from_bd(sql, params=None, one_row=False):
+        with lock:
+            rows = [dict(row) for row in conn.execute(sql.replace('%s', '?'), params or ())]
+        if not rows:
+            return None
+        return rows[0] if one_row else rows
+
+    def put_many_to_bd(statements):
+        try:
+            with lock:
+                for sql, params in statements:
+                    conn.execute(sql.replace('%s', '?'), params or ())
+                conn.commit()
+            return True
+        except sqlite3.Error as e:
+            conn.rollback()
+            print(f'Ошибка: {e}')
+            return False
+
+    db.get_from_bd = get_from_bd
+    db.put_many_to_bd = put_many_to_bd
+    db.put_to_bd = lambda sql, params=None: put_many_to_bd([(sql, params)])
+    db.ping = lambda: True
+    # Схема стенда уже создана, итоги игр в стенде не сохраняются
+    db.migrate_schema = lambda: True
+    db.save_rooms = lambda rooms: {'success': True}
+
+    app = create_app()
+    socketio.run(app, host='127.0.0.1', port=port, log_output=False)
+
+
+def wait_for_server(url, timeout):
+    import httpx
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(f'{url}/api/rooms/list', timeout=1)
+            return True
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default='http://127.0.0.1:5055')
+    parser.add_argument('--rooms', type=int, default=10)
+    parser.add_argument('--players', type=int, default=5)
+    parser.add_argument('--questions', type=int, default=5)
+    parser.add_argument('--category-id', default=None)
+    parser.add_argument('--answer-delay', type=float, default=3.0, help='максимальное время на ответ, с')
+    parser.add_argument('--accuracy', type=float, default=0.7, help='доля правильных ответов')
+    parser.add_argument('--concurrency', type=int, default=50, help='одновременных входов через REST')
+    parser.add_argument('--ramp-up', type=float, default=5.0, help='за сколько секунд запускаются все комнаты')
+    parser.add_argument('--lobby-wait', type=float, default=1.0)
+    parser.add_argument('--game-timeout', type=float, default=600.0)
+    parser.add_argument('--request-timeout', type=float, default=30.0)
+    parser.add_argument('--transport', default='websocket', choices=['websocket', 'polling'])
+    parser.add_argument('--server-pid', type=int, action='append', default=[])
+    parser.add_argument('--self-host', action='store_true', help='поднять сервер со стендами на --url')
+    parser.add_argument('--bank-size', type=int, default=10_000)
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    port = int(args.url.rsplit(':', 1)[1].split('/')[0])
+    if args.serve:
+        serve(port, args.bank_size)
+        return
+
+    try:
+        import httpx  # noqa: F401
+        import socketio  # noqa: F401
+        import aiohttp  # noqa: F401
+    except ImportError as e:
+        sys.exit(f'Нужны клиентские зависимости ({e.name}): pip install -r benchmarks/requirements.txt')
+
+    server = None
+    server_pids = list(args.server_pid)
+    if args.self_host:
+        server = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', '--url', args.url,
+                                   '--bank-size', str(args.bank_size)],
+                                  stdout=subprocess.DEVNULL, stderr=None if args.verbose else subprocess.DEVNULL)
+        server_pids.append(server.pid)
+        if args.category_id is None:
+            args.category_id = 'cat-1'
+        if not wait_for_server(args.url, 60):
+            server.kill()
+            sys.exit('Сервер со стендами не запустился')
+    try:
+        print(json.dumps(asyncio.run(run(args, server_pids)), indent=2, ensure_ascii=False))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(10)
+
+
+if __name__ == '__main__':
+    main()